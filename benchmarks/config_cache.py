@@ -0,0 +1,49 @@
+"""Counts config.ini reads made by a batch of config.get_value calls.
+
+Usage: python benchmarks/config_cache.py [number_of_calls]
+"""
+import configparser
+import os
+import sys
+import tempfile
+import time
+
+import sroka.config.config as config
+
+
+def _uncached_get_value(config_path, group, key):
+    parser = configparser.ConfigParser()
+    parser.read(config_path)
+    return parser.get(group, key)
+
+
+def main(calls=10000):
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.ini')
+        with open(config_path, 'w') as file:
+            file.write('[mysql]\nhost: localhost\nport: 3306\nuser: user\n')
+        os.chmod(config_path, 0o600)
+        os.environ['CONFIG_FILE_PATH'] = config_path
+        config.clear_config_cache()
+
+        start = time.perf_counter()
+        for _ in range(calls):
+            _uncached_get_value(config_path, 'mysql', 'host')
+        uncached_time = time.perf_counter() - start
+
+        before = config.get_config_cache_stats()
+        start = time.perf_counter()
+        for _ in range(calls):
+            config.get_value('mysql', 'host')
+        cached_time = time.perf_counter() - start
+        after = config.get_config_cache_stats()
+
+    reads = after['reads'] - before['reads']
+    print('calls: {}'.format(calls))
+    print('uncached: {} reads, {:.3f}s'.format(calls, uncached_time))
+    print('cached:   {} reads, {:.3f}s'.format(reads, cached_time))
+    print('saved reads: {}'.format(calls - reads))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,81 @@
+"""Compares building a DataFrame of Ad Manager users with one pd.concat per user and with a single list.
+
+Pages come from a fake UserService returning zeep-like entities, so no Ad Manager network is needed.
+
+Usage: python benchmarks/gam_entities.py [largest_number_of_users]
+"""
+import re
+import sys
+import time
+
+import pandas as pd
+from googleads import ad_manager
+
+from sroka.api.google_ad_manager.gam_api import get_dimensions_from_admanager
+
+DIMENSIONS = ['id', 'name', 'email', 'roleName', 'isActive']
+# the previous implementation takes minutes for more users
+MAX_CONCAT_USERS = 2000
+
+
+class FakeEntity:
+    """Item access like zeep CompoundValue, KeyError for unknown fields."""
+
+    def __init__(self, **values):
+        self.__values__ = values
+
+    def __getitem__(self, key):
+        return self.__values__[key]
+
+
+class FakeUserService:
+
+    def __init__(self, number_of_users):
+        self.users = [FakeEntity(id=i, name='User {}'.format(i), email='user{}@example.com'.format(i),
+                                 roleName='Trafficker', isActive=i % 3 > 0, isEmailNotificationAllowed=True)
+                      for i in range(number_of_users)]
+
+    def getUsersByStatement(self, statement):
+        match = re.search(r'LIMIT (\d+) OFFSET (\d+)', statement['query'])
+        limit, offset = int(match.group(1)), int(match.group(2))
+        return {'results': self.users[offset:offset + limit]}
+
+
+def concat_per_entity(fetch_method, statement, dimensions):
+    """The previous implementation."""
+    user_df = pd.DataFrame()
+    dimensions_df = pd.DataFrame()
+    while True:
+        response = fetch_method(statement.ToStatement())
+        if 'results' in response and len(response['results']):
+            for user in response['results']:
+                for dimension in dimensions:
+                    dimensions_df[dimension] = [user[dimension]]
+                user_df = pd.concat([user_df, dimensions_df], sort=False)
+            statement.offset += statement.limit
+        else:
+            break
+    return user_df
+
+
+def measure(name, build, number_of_users):
+    service = FakeUserService(number_of_users)
+    start = time.perf_counter()
+    df = build(service.getUsersByStatement, ad_manager.StatementBuilder(), DIMENSIONS)
+    elapsed = time.perf_counter() - start
+    assert len(df) == number_of_users
+    print('{:18} {:>8,} users  {:>8.3f} s  {:>8.1f} us/user'.format(
+        name, number_of_users, elapsed, elapsed / number_of_users * 10 ** 6))
+
+
+def main(largest_number_of_users=64000):
+    number_of_users = 500
+    while number_of_users <= largest_number_of_users:
+        if number_of_users <= MAX_CONCAT_USERS:
+            measure('concat per entity', concat_per_entity, number_of_users)
+        measure('single list', get_dimensions_from_admanager, number_of_users)
+        number_of_users *= 2
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64000)
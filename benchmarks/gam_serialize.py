@@ -0,0 +1,119 @@
+"""Compares serialize_gam_object flattening whole objects and reading only kept columns by precomputed key paths.
+
+Objects are built from a small schema shaped like Ad Manager line items, so no Ad Manager network is needed.
+
+Usage: python benchmarks/gam_serialize.py [number_of_objects]
+"""
+import datetime
+import sys
+import time
+
+from lxml import etree
+from zeep import xsd
+
+from sroka.api.google_ad_manager.gam_api import serialize_gam_object
+
+SCHEMA = """
+<schema xmlns="http://www.w3.org/2001/XMLSchema" xmlns:t="urn:benchmark" targetNamespace="urn:benchmark"
+        elementFormDefault="qualified">
+  <complexType name="Money">
+    <sequence>
+      <element name="currencyCode" type="string" minOccurs="0"/>
+      <element name="microAmount" type="long" minOccurs="0"/>
+    </sequence>
+  </complexType>
+  <complexType name="Size">
+    <sequence>
+      <element name="width" type="int" minOccurs="0"/>
+      <element name="height" type="int" minOccurs="0"/>
+      <element name="isAspectRatio" type="boolean" minOccurs="0"/>
+    </sequence>
+  </complexType>
+  <complexType name="CreativePlaceholder">
+    <sequence>
+      <element name="size" type="t:Size" minOccurs="0"/>
+      <element name="expectedCreativeCount" type="int" minOccurs="0"/>
+    </sequence>
+  </complexType>
+  <complexType name="Goal">
+    <sequence>
+      <element name="goalType" type="string" minOccurs="0"/>
+      <element name="unitType" type="string" minOccurs="0"/>
+      <element name="units" type="long" minOccurs="0"/>
+    </sequence>
+  </complexType>
+  <complexType name="Stats">
+    <sequence>
+      <element name="impressionsDelivered" type="long" minOccurs="0"/>
+      <element name="clicksDelivered" type="long" minOccurs="0"/>
+      <element name="videoCompletionsDelivered" type="long" minOccurs="0"/>
+    </sequence>
+  </complexType>
+  <complexType name="LineItem">
+    <sequence>
+      <element name="orderId" type="long" minOccurs="0"/>
+      <element name="id" type="long" minOccurs="0"/>
+      <element name="name" type="string" minOccurs="0"/>
+      <element name="startDateTime" type="dateTime" minOccurs="0"/>
+      <element name="endDateTime" type="dateTime" minOccurs="0"/>
+      <element name="lineItemType" type="string" minOccurs="0"/>
+      <element name="priority" type="int" minOccurs="0"/>
+      <element name="costPerUnit" type="t:Money" minOccurs="0"/>
+      <element name="budget" type="t:Money" minOccurs="0"/>
+      <element name="creativePlaceholders" type="t:CreativePlaceholder" minOccurs="0" maxOccurs="unbounded"/>
+      <element name="status" type="string" minOccurs="0"/>
+      <element name="primaryGoal" type="t:Goal" minOccurs="0"/>
+      <element name="stats" type="t:Stats" minOccurs="0"/>
+      <element name="appliedLabels" type="long" minOccurs="0" maxOccurs="unbounded"/>
+    </sequence>
+  </complexType>
+</schema>
+"""
+
+COLUMNS_TO_KEEP = ['id', 'orderId', 'name', 'status', 'lineItemType', 'primaryGoal_units', 'costPerUnit_microAmount',
+                   'stats_impressionsDelivered']
+
+
+def build_line_items(number_of_objects):
+    schema = xsd.Schema(etree.fromstring(SCHEMA))
+    line_item, money, size, placeholder, goal, stats = [
+        schema.get_type('{urn:benchmark}' + name)
+        for name in ('LineItem', 'Money', 'Size', 'CreativePlaceholder', 'Goal', 'Stats')]
+    start = datetime.datetime(2020, 1, 1)
+    return [line_item(orderId=i // 10, id=i, name='Line item {}'.format(i), startDateTime=start,
+                      endDateTime=start + datetime.timedelta(days=30), lineItemType='STANDARD', priority=8,
+                      costPerUnit=money(currencyCode='USD', microAmount=2000000),
+                      budget=money(currencyCode='USD', microAmount=i * 1000000),
+                      creativePlaceholders=[placeholder(size=size(width=300, height=250, isAspectRatio=False),
+                                                        expectedCreativeCount=1),
+                                            placeholder(size=size(width=728, height=90, isAspectRatio=False),
+                                                        expectedCreativeCount=1)],
+                      status='DELIVERING', primaryGoal=goal(goalType='LIFETIME', unitType='IMPRESSIONS', units=10 ** 6),
+                      stats=stats(impressionsDelivered=i * 100, clicksDelivered=i, videoCompletionsDelivered=0),
+                      appliedLabels=[1, 2, 3])
+            for i in range(number_of_objects)]
+
+
+def keep_columns(flattened_data):
+    return {key: flattened_data.get(key) for key in COLUMNS_TO_KEEP}
+
+
+def measure(name, serialize, line_items):
+    start = time.perf_counter()
+    rows = [serialize(line_item) for line_item in line_items]
+    elapsed = time.perf_counter() - start
+    print('{:32} {:>12,.0f} objects/s'.format(name, len(line_items) / elapsed))
+    return rows
+
+
+def main(number_of_objects=50000):
+    line_items = build_line_items(number_of_objects)
+    measure('all columns', serialize_gam_object, line_items)
+    # with full flattening first, as serialize_gam_object did before key paths were used
+    flattened = measure('all columns, then kept ones', lambda obj: keep_columns(serialize_gam_object(obj)), line_items)
+    kept = measure('kept columns by key paths', lambda obj: serialize_gam_object(obj, COLUMNS_TO_KEEP), line_items)
+    assert flattened == kept
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
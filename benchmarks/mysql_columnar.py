@@ -0,0 +1,121 @@
+"""Compares the tuple and the columnar (Arrow) way of building DataFrames from MySQL cursor rows.
+
+Rows come from a fake cursor, so no MySQL server is needed. Two tables are used: a narrow one with mixed
+column types and a wide one with numeric columns only.
+
+Speed is measured without tracemalloc, best of a few runs. Memory is measured in a separate, fresh process
+for every case: peak of Python and NumPy allocations (tracemalloc), peak of the Arrow memory pool, which
+tracemalloc does not see, and growth of RSS while the DataFrame is built (Linux only).
+
+Usage: python benchmarks/mysql_columnar.py [number_of_rows]
+"""
+import datetime
+import decimal
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+from mysql.connector.constants import FieldType
+
+from sroka.api.mysql.mysql_columnar import fetch_frame
+
+NARROW_DESCRIPTION = [('id', FieldType.LONGLONG), ('clicks', FieldType.LONG), ('ctr', FieldType.DOUBLE),
+                      ('revenue', FieldType.NEWDECIMAL), ('created', FieldType.DATETIME),
+                      ('name', FieldType.VAR_STRING)]
+WIDE_DESCRIPTION = ([('int_{}'.format(i), FieldType.LONGLONG) for i in range(15)] +
+                    [('double_{}'.format(i), FieldType.DOUBLE) for i in range(15)])
+REPEAT = 3
+
+
+def narrow_rows(number_of_rows):
+    start = datetime.datetime(2020, 1, 1)
+    return [(i, i % 1000, i / 7, decimal.Decimal(i) / 100, start + datetime.timedelta(seconds=i),
+             'name_{}'.format(i % 50)) for i in range(number_of_rows)]
+
+
+def wide_rows(number_of_rows):
+    return [tuple(range(i, i + 15)) + tuple(i / (j + 1) for j in range(15)) for i in range(number_of_rows)]
+
+
+TABLES = {
+    'narrow': (NARROW_DESCRIPTION, narrow_rows),
+    'wide': (WIDE_DESCRIPTION, wide_rows),
+}
+
+
+class FakeCursor:
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+        self.position = 0
+        self.column_names = [column[0] for column in self.description]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += size
+        return rows
+
+
+BUILDERS = {
+    'tuples': lambda cursor: pd.DataFrame(cursor, columns=cursor.column_names),
+    'columnar': fetch_frame,
+}
+
+
+def measure_speed(table, builder, number_of_rows):
+    description, build_rows = TABLES[table]
+    rows = build_rows(number_of_rows)
+    elapsed = []
+    for _ in range(REPEAT):
+        cursor = FakeCursor(description, rows)
+        start = time.perf_counter()
+        BUILDERS[builder](cursor)
+        elapsed.append(time.perf_counter() - start)
+    return number_of_rows / min(elapsed)
+
+
+def current_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure_memory(table, builder, number_of_rows):
+    # runs in a fresh (spawned) process, so the peak of the Arrow pool comes from this case only
+    description, build_rows = TABLES[table]
+    cursor = FakeCursor(description, build_rows(number_of_rows))
+    rss_before = current_rss()
+    tracemalloc.start()
+    df = BUILDERS[builder](cursor)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_growth = current_rss() - rss_before
+    return (python_peak, pa.default_memory_pool().max_memory(), rss_growth, df.memory_usage(deep=True).sum(),
+            list(df.columns[df.dtypes == object]))
+
+
+def main(number_of_rows=1000000):
+    mb = 1024 ** 2
+    for table in TABLES:
+        print('{} table, {:,} rows'.format(table, number_of_rows))
+        for builder in BUILDERS:
+            rows_per_second = measure_speed(table, builder, number_of_rows)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                python_peak, arrow_peak, rss_growth, frame_size, object_columns = executor.submit(
+                    measure_memory, table, builder, number_of_rows).result()
+            print('  {:8} {:>12,.0f} rows/s  peak: python {:>7.1f} MB, arrow {:>7.1f} MB, rss +{:>7.1f} MB  '
+                  'frame {:>7.1f} MB  object columns: {}'.format(
+                      builder, rows_per_second, python_peak / mb, arrow_peak / mb, rss_growth / mb,
+                      frame_size / mb, object_columns))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,16 +1,31 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import NoOptionError
-from urllib.parse import urlparse
 
-import boto3
-from botocore.exceptions import ClientError, EndpointConnectionError
+import pandas as pd
+from botocore.exceptions import (BotoCoreError, ClientError,
+                                 EndpointConnectionError)
 
 import sroka.config.config as config
-from sroka.api.athena.athena_api_helpers import (download_file, input_check,
+from sroka.api.athena.athena_api_helpers import (FINISHED_STATES,
+                                                 MAX_POLL_INTERVAL,
+                                                 MIN_POLL_INTERVAL,
+                                                 RESULTS_API_MAX_BYTES,
+                                                 download_results,
+                                                 find_reusable_execution,
+                                                 input_check,
+                                                 next_poll_interval,
                                                  poll_status,
                                                  return_on_exception)
+from sroka.api.aws.aws_session import get_client, get_resource
+from sroka.cache.result_cache import cached_query
 
+# Number of times in a row submitting a query may fail because of connection errors before it is given up.
+SUBMIT_RETRIES = 5
 
-def query_athena(query, filename=None):
+
+def query_athena(query, filename=None, cache=False, refresh_cache=False, reuse_max_age_minutes=None,
+                 workgroup=None, results_api_max_bytes=RESULTS_API_MAX_BYTES):
 
     if not input_check(query, [str]):
         return return_on_exception(filename)
@@ -32,26 +47,38 @@ def query_athena(query, filename=None):
         print(e)
         return return_on_exception(filename)
 
-    session = boto3.Session(
-        aws_access_key_id=key_id,
-        aws_secret_access_key=access_key
-    )
+    if cache and not filename:
+        return cached_query('athena', (key_id, access_key, region, s3_bucket), query,
+                            lambda: query_athena(query, reuse_max_age_minutes=reuse_max_age_minutes,
+                                                 workgroup=workgroup, results_api_max_bytes=results_api_max_bytes),
+                            refresh=refresh_cache)
 
-    athena = session.client('athena',
-                            region_name=region)
-    s3 = session.resource('s3')
-    if not s3_bucket.startswith('s3://'):
-        output_s3_bucket = 's3://' + s3_bucket
-    else:
-        output_s3_bucket = s3_bucket
-        s3_bucket = s3_bucket.replace('s3://', '')
+    athena = get_client('athena', key_id, access_key, region)
+    s3 = get_resource('s3', key_id, access_key)
+    output_s3_bucket = s3_bucket if s3_bucket.startswith('s3://') else 's3://' + s3_bucket
+    execution_parameters = {
+        'QueryString': query,
+        'ResultConfiguration': {
+            'OutputLocation': output_s3_bucket,
+        }
+    }
+    if workgroup:
+        execution_parameters['WorkGroup'] = workgroup
     try:
-        result = athena.start_query_execution(
-            QueryString=query,
-            ResultConfiguration={
-                'OutputLocation': output_s3_bucket,
+        if reuse_max_age_minutes:
+            # results of an identical query which finished recently are downloaded without running it again
+            execution = find_reusable_execution(athena, query, workgroup or 'primary', reuse_max_age_minutes)
+            if execution is not None:
+                print('Reusing results of query {}'.format(execution['QueryExecutionId']))
+                return download_results(athena, s3, execution, filename, results_api_max_bytes)
+            # Athena engine v3 can also reuse results of queries submitted by other clients
+            execution_parameters['ResultReuseConfiguration'] = {
+                'ResultReuseByAgeConfiguration': {
+                    'Enabled': True,
+                    'MaxAgeInMinutes': reuse_max_age_minutes
+                }
             }
-        )
+        result = athena.start_query_execution(**execution_parameters)
     except ClientError as e:
         if e.response['Error']['Code'] == 'InvalidRequestException':
             print("Please check your query. Error message:")
@@ -72,15 +99,15 @@ def query_athena(query, filename=None):
         return return_on_exception(filename)
 
     elif result['QueryExecution']['Status']['State'] == 'SUCCEEDED':
-        s3_key = query_id + '.csv'
-        return download_file(s3, s3_bucket, s3_key, filename)
+        # results reused by Athena are stored where the original query saved them
+        return download_results(athena, s3, result['QueryExecution'], filename, results_api_max_bytes)
     else:
         print('Query did not succeed. Reason:')
         print(result['QueryExecution']['Status']['StateChangeReason'])
         return return_on_exception(filename)
 
 
-def done_athena(query_id, filename=None):
+def done_athena(query_id, filename=None, results_api_max_bytes=RESULTS_API_MAX_BYTES):
 
     if not input_check(query_id, [str]):
         return return_on_exception(filename)
@@ -89,7 +116,6 @@ def done_athena(query_id, filename=None):
         return return_on_exception(filename)
 
     try:
-        s3_bucket = config.get_value('aws', 's3bucket_name')
         key_id = config.get_value('aws', 'aws_access_key_id')
         access_key = config.get_value('aws', 'aws_secret_access_key')
         region = config.get_value('aws', 'aws_region')
@@ -98,24 +124,146 @@ def done_athena(query_id, filename=None):
         print(e)
         return return_on_exception(filename)
 
-    if s3_bucket.startswith('s3://'):
-        s3_bucket = s3_bucket.replace('s3://', '')
-
-    session = boto3.Session(
-        aws_access_key_id=key_id,
-        aws_secret_access_key=access_key
-    )
-
-    s3 = session.resource('s3')
-    athena = session.client('athena',
-                            region_name=region)
+    s3 = get_resource('s3', key_id, access_key)
+    athena = get_client('athena', key_id, access_key, region)
     result = poll_status(athena, query_id)
     if result is None:
         return return_on_exception(filename)
     if result['QueryExecution']['Status']['State'] == 'SUCCEEDED':
-        s3_key = urlparse(result['QueryExecution']['ResultConfiguration']['OutputLocation']).path[1:]
-        return download_file(s3, s3_bucket, s3_key, filename)
+        return download_results(athena, s3, result['QueryExecution'], filename, results_api_max_bytes)
     else:
         print('Query did not succeed. Reason:')
         print(result['QueryExecution']['Status']['StateChangeReason'])
         return return_on_exception(filename)
+
+
+def query_athena_batch(queries, filenames=None, max_concurrent=20, workgroup=None,
+                       results_api_max_bytes=RESULTS_API_MAX_BYTES):
+    """Runs many independent queries at once.
+
+    All queries are submitted up front, keeping at most max_concurrent of them running (the active queries quota
+    of the account), polled together and downloaded as soon as each of them ends.
+
+    :param list queries: queries to run, without duplicates
+    :param list filenames: optional list of files, one per query, where results should be stored
+    :param int max_concurrent: maximal number of queries running at the same time
+    :param str workgroup: Athena workgroup to run the queries in
+    :param int results_api_max_bytes: results up to this size are read with get_query_results instead of S3
+    :return: dict of query to DataFrame (or None if saved to file or failed) and DataFrame with query id, state,
+        queue, execution and download time in seconds and bytes scanned by every query
+    """
+    if not isinstance(queries, list) or not all(input_check(query, [str]) for query in queries):
+        print('queries must be a list of nonempty strings')
+        return {}, pd.DataFrame([])
+    if filenames is not None and (not isinstance(filenames, list) or len(filenames) != len(queries)):
+        print('filenames must be a list with one filename per query')
+        return {}, pd.DataFrame([])
+    if len(set(queries)) != len(queries):
+        # results are returned per query
+        print('queries must not contain duplicates')
+        return {}, pd.DataFrame([])
+    filenames = filenames or [None] * len(queries)
+
+    try:
+        s3_bucket = config.get_value('aws', 's3bucket_name')
+        key_id = config.get_value('aws', 'aws_access_key_id')
+        access_key = config.get_value('aws', 'aws_secret_access_key')
+        region = config.get_value('aws', 'aws_region')
+    except (KeyError, NoOptionError) as e:
+        print('No credentials were provided. Error message:')
+        print(e)
+        return {}, pd.DataFrame([])
+
+    athena = get_client('athena', key_id, access_key, region)
+    output_s3_bucket = s3_bucket if s3_bucket.startswith('s3://') else 's3://' + s3_bucket
+    execution_parameters = {'ResultConfiguration': {'OutputLocation': output_s3_bucket}}
+    if workgroup:
+        execution_parameters['WorkGroup'] = workgroup
+
+    def download(execution, filename):
+        # s3 resources are created per thread
+        s3 = get_resource('s3', key_id, access_key)
+        start = time.monotonic()
+        result = download_results(athena, s3, execution, filename, results_api_max_bytes)
+        return result, time.monotonic() - start
+
+    pending = list(zip(queries, filenames))
+    running = {}
+    results = {}
+    statistics = {}
+    downloads = {}
+    poll_interval = MIN_POLL_INTERVAL
+    submit_failures = 0
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        while pending or running:
+            while pending and len(running) < max_concurrent:
+                query, filename = pending[0]
+                try:
+                    result = athena.start_query_execution(QueryString=query, **execution_parameters)
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'TooManyRequestsException':
+                        # the quota is lower than max_concurrent, the query is submitted when another one ends
+                        break
+                    print('Query could not be submitted. Error message:')
+                    print(e)
+                    pending.pop(0)
+                    results[query] = return_on_exception(filename)
+                    continue
+                except BotoCoreError as e:
+                    # e.g. connection errors, the query is submitted again in the next loop
+                    submit_failures += 1
+                    print('Query could not be submitted. Error message:')
+                    print(e)
+                    if submit_failures > SUBMIT_RETRIES:
+                        pending.pop(0)
+                        results[query] = return_on_exception(filename)
+                        submit_failures = 0
+                        continue
+                    poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+                    break
+                submit_failures = 0
+                pending.pop(0)
+                running[result['QueryExecutionId']] = (query, filename)
+
+            time.sleep(poll_interval)
+            if not running:
+                continue
+            running_ids = list(running)
+            executions = []
+            try:
+                # up to 50 executions can be checked in a single call
+                for index in range(0, len(running_ids), 50):
+                    executions.extend(athena.batch_get_query_execution(
+                        QueryExecutionIds=running_ids[index:index + 50])['QueryExecutions'])
+            except (ClientError, BotoCoreError) as e:
+                # e.g. throttling or connection errors, the queries are checked again at the next poll
+                print('Query statuses could not be checked, retrying. Error message:')
+                print(e)
+                poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+                continue
+
+            poll_interval = min([next_poll_interval({'QueryExecution': execution}) for execution in executions
+                                 if execution['Status']['State'] not in FINISHED_STATES] or [MIN_POLL_INTERVAL])
+            for execution in executions:
+                if execution['Status']['State'] not in FINISHED_STATES:
+                    continue
+                query, filename = running.pop(execution['QueryExecutionId'])
+                execution_statistics = execution.get('Statistics', {})
+                statistics[query] = {
+                    'query_id': execution['QueryExecutionId'],
+                    'state': execution['Status']['State'],
+                    'queue_seconds': execution_statistics.get('QueryQueueTimeInMillis', 0) / 1000,
+                    'execution_seconds': execution_statistics.get('EngineExecutionTimeInMillis', 0) / 1000,
+                    'data_scanned_bytes': execution_statistics.get('DataScannedInBytes', 0),
+                }
+                if execution['Status']['State'] == 'SUCCEEDED':
+                    downloads[query] = executor.submit(download, execution, filename)
+                else:
+                    print('Query {} did not succeed. Reason:'.format(execution['QueryExecutionId']))
+                    print(execution['Status'].get('StateChangeReason'))
+                    results[query] = return_on_exception(filename)
+
+        for query, future in downloads.items():
+            results[query], statistics[query]['download_seconds'] = future.result()
+
+    return results, pd.DataFrame.from_dict(statistics, orient='index')
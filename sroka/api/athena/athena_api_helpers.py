@@ -1,6 +1,27 @@
+import asyncio
+import datetime
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 import pandas as pd
 from botocore.exceptions import ClientError, EndpointConnectionError
-from retrying import retry
+
+FINISHED_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 10
+POLL_INTERVAL_RATIO = 0.1
+# Results smaller than this are paged through get_query_results instead of being downloaded from S3.
+RESULTS_API_MAX_BYTES = 1024 * 1024
+RESULTS_API_PAGE_SIZE = 1000
+INTEGER_TYPES = ('tinyint', 'smallint', 'integer', 'int', 'bigint')
+FLOAT_TYPES = ('float', 'real', 'double', 'decimal')
+DATETIME_TYPES = ('date', 'timestamp')
+# String columns of results with at least CATEGORY_MIN_ROWS rows are returned as categoricals
+# if they have at most CATEGORY_MAX_UNIQUE_RATIO unique values per row.
+CATEGORY_MIN_ROWS = 1000
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
 
 
 def input_check(input_to_check, expected_types):
@@ -18,12 +39,9 @@ def return_on_exception(filename):
     return None if filename or filename == '' else pd.DataFrame([])
 
 
-@retry(stop_max_attempt_number=10,
-       wait_exponential_multiplier=1 * 1000,
-       wait_exponential_max=10 * 60 * 1000)
-def poll_status(session, _id):
+def _get_query_execution(session, _id):
     try:
-        result = session.get_query_execution(
+        return session.get_query_execution(
             QueryExecutionId=_id
         )
     except ClientError as e:
@@ -39,16 +57,217 @@ def poll_status(session, _id):
         print(e)
         return None
 
-    state = result['QueryExecution']['Status']['State']
 
-    if state in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
-        return result
+def is_finished(result):
+    return result['QueryExecution']['Status']['State'] in FINISHED_STATES
+
+
+def next_poll_interval(result):
+    """Chooses seconds to wait before checking the query again, based on statistics reported by Athena.
+
+    Queries which have been running for a while are likely to run a while longer, so they are checked
+    less often: every POLL_INTERVAL_RATIO of their run time, between MIN_POLL_INTERVAL and MAX_POLL_INTERVAL.
+    """
+    statistics = result['QueryExecution'].get('Statistics', {})
+    if result['QueryExecution']['Status']['State'] == 'QUEUED':
+        elapsed = statistics.get('QueryQueueTimeInMillis', 0) / 1000
     else:
-        print('Waiting for {} query to end'.format(_id))
-        raise Exception
+        elapsed = statistics.get('EngineExecutionTimeInMillis', statistics.get('TotalExecutionTimeInMillis', 0)) / 1000
+    return min(max(elapsed * POLL_INTERVAL_RATIO, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+
+def poll_status(session, _id, timeout=None):
+    """Waits until the query ends and returns its execution, or None in case of an error or timeout."""
+    start = time.monotonic()
+    state = None
+    while True:
+        result = _get_query_execution(session, _id)
+        if result is None or is_finished(result):
+            return result
+        if result['QueryExecution']['Status']['State'] != state:
+            state = result['QueryExecution']['Status']['State']
+            print('Waiting for {} query to end ({})'.format(_id, state))
+        if timeout is not None and time.monotonic() - start > timeout:
+            print('Query {} did not end in {} seconds'.format(_id, timeout))
+            return None
+        time.sleep(next_poll_interval(result))
+
+
+async def poll_status_async(session, _id, timeout=None):
+    """Asyncio version of poll_status. Blocking boto3 calls run in the default executor, so many queries
+    can be tracked concurrently by a single event loop."""
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    state = None
+    while True:
+        result = await loop.run_in_executor(None, _get_query_execution, session, _id)
+        if result is None or is_finished(result):
+            return result
+        if result['QueryExecution']['Status']['State'] != state:
+            state = result['QueryExecution']['Status']['State']
+            print('Waiting for {} query to end ({})'.format(_id, state))
+        if timeout is not None and time.monotonic() - start > timeout:
+            print('Query {} did not end in {} seconds'.format(_id, timeout))
+            return None
+        await asyncio.sleep(next_poll_interval(result))
+
+
+def poll_statuses(session, ids, timeout=None):
+    """Waits until all queries end and returns a dict of query id to execution (None in case of an error)."""
+    async def poll_all():
+        return await asyncio.gather(*[poll_status_async(session, _id, timeout) for _id in ids])
+    return dict(zip(ids, run_coroutine(poll_all())))
+
+
+def run_coroutine(coroutine):
+    """Runs a coroutine to completion, also when called from a running event loop (e.g. in Jupyter)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def find_reusable_execution(athena, query, workgroup, max_age_minutes, max_executions=100):
+    """Returns the most recent succeeded execution of the same query in the workgroup, not older than max_age_minutes,
+    or None."""
+    oldest_completion = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=max_age_minutes)
+    query = query.strip()
+    checked_executions = 0
+    kwargs = {'WorkGroup': workgroup, 'MaxResults': 50}
+    # executions are listed from the most recent one
+    while checked_executions < max_executions:
+        response = athena.list_query_executions(**kwargs)
+        execution_ids = response.get('QueryExecutionIds', [])
+        if not execution_ids:
+            return None
+        executions = athena.batch_get_query_execution(QueryExecutionIds=execution_ids)['QueryExecutions']
+        executions.sort(key=lambda execution: execution['Status'].get('SubmissionDateTime'), reverse=True)
+        for execution in executions:
+            status = execution['Status']
+            if (status['State'] == 'SUCCEEDED' and execution.get('StatementType') == 'DML' and
+                    execution['Query'].strip() == query and status['CompletionDateTime'] >= oldest_completion):
+                return execution
+        checked_executions += len(execution_ids)
+        if 'NextToken' not in response:
+            return None
+        kwargs['NextToken'] = response['NextToken']
+    return None
+
+
+def get_column_info(athena, query_id):
+    """Returns the ColumnInfo list of the query results, or None if it cannot be read."""
+    try:
+        response = athena.get_query_results(QueryExecutionId=query_id, MaxResults=1)
+    except ClientError as e:
+        print('Column types of query {} could not be read. Error message:'.format(query_id))
+        print(e)
+        return None
+    return response['ResultSet']['ResultSetMetadata']['ColumnInfo']
+
+
+def get_output_bytes(athena, query_id):
+    """Returns the size of the query results in bytes, or None if Athena does not report it."""
+    try:
+        statistics = athena.get_query_runtime_statistics(QueryExecutionId=query_id)
+    except ClientError:
+        return None
+    return statistics.get('QueryRuntimeStatistics', {}).get('Rows', {}).get('OutputBytes')
+
+
+def get_csv_dtypes(column_info):
+    """Returns dtype and parse_dates arguments of read_csv for results with given columns."""
+    dtype = {}
+    parse_dates = []
+    for column in column_info:
+        athena_type = column['Type'].lower()
+        if athena_type in INTEGER_TYPES:
+            dtype[column['Name']] = 'Int64'
+        elif athena_type in FLOAT_TYPES:
+            dtype[column['Name']] = 'float64'
+        elif athena_type == 'boolean':
+            dtype[column['Name']] = 'boolean'
+        elif athena_type in DATETIME_TYPES:
+            parse_dates.append(column['Name'])
+        else:
+            dtype[column['Name']] = 'object'
+    return dtype, parse_dates
+
+
+def convert_types(df, column_info):
+    """Converts columns to pandas types matching their Athena types. Columns may hold strings (None for NULL)
+    or already be parsed by read_csv.
 
+    Integers become nullable Int64, so that big ids are not rounded, floating point and decimal numbers
+    float64, booleans nullable boolean and dates and timestamps datetime64[us]. Other columns stay strings,
+    converted to category if they have at most CATEGORY_MAX_UNIQUE_RATIO unique values per row.
+    """
+    for position, column in enumerate(column_info):
+        athena_type = column['Type'].lower()
+        series = df.iloc[:, position]
+        if series.dtype == object:
+            series = series.where(series.notna(), None)
+        if athena_type in INTEGER_TYPES:
+            series = series.astype('Int64')
+        elif athena_type in FLOAT_TYPES:
+            series = series.astype('float64')
+        elif athena_type == 'boolean':
+            if series.dtype == object:
+                series = series.map({'true': True, 'false': False})
+            series = series.astype('boolean')
+        elif athena_type in DATETIME_TYPES:
+            series = pd.to_datetime(series).astype('datetime64[us]')
+        elif len(series) >= CATEGORY_MIN_ROWS and series.nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(series):
+            series = series.astype('category')
+        df.isetitem(position, series)
+    return df
 
-def download_file(s3, s3_bucket, s3_key, filename):
+
+def fetch_query_results(athena, query_id):
+    """Pages through get_query_results and returns a typed DataFrame, or None in case of an error."""
+    paginator = athena.get_paginator('get_query_results')
+    column_info = None
+    rows = []
+    try:
+        for page in paginator.paginate(QueryExecutionId=query_id,
+                                       PaginationConfig={'PageSize': RESULTS_API_PAGE_SIZE}):
+            if column_info is None:
+                column_info = page['ResultSet']['ResultSetMetadata']['ColumnInfo']
+            # a missing VarCharValue stands for NULL
+            rows.extend([field.get('VarCharValue') for field in row['Data']] for row in page['ResultSet']['Rows'])
+    except ClientError as e:
+        print('Results of query {} could not be read. Error message:'.format(query_id))
+        print(e)
+        return None
+    # the first row of results of a SELECT query is its header
+    df = pd.DataFrame(rows[1:], columns=[column['Name'] for column in column_info], dtype=object)
+    # the CSV file in S3 does not tell empty strings from NULL, so neither does this path
+    df = df.where(df != '', None)
+    return convert_types(df, column_info)
+
+
+def download_results(athena, s3, execution, filename, results_api_max_bytes=RESULTS_API_MAX_BYTES):
+    """Returns results of a succeeded query execution as a DataFrame, or saves them to filename.
+
+    Small results of SELECT queries are read with get_query_results, larger ones and results of other
+    statements are downloaded from the output location in S3.
+    """
+    query_id = execution['QueryExecutionId']
+    if not filename and results_api_max_bytes and execution.get('StatementType') == 'DML':
+        output_bytes = get_output_bytes(athena, query_id)
+        if output_bytes is not None and output_bytes <= results_api_max_bytes:
+            df = fetch_query_results(athena, query_id)
+            if df is not None:
+                return df
+    output_location = urlparse(execution['ResultConfiguration']['OutputLocation'])
+    column_info = None
+    if not filename and execution.get('StatementType') == 'DML':
+        column_info = get_column_info(athena, query_id)
+    return download_file(s3, output_location.netloc, output_location.path[1:], filename, column_info)
+
+
+def download_file(s3, s3_bucket, s3_key, filename, column_info=None):
     if filename:
         try:
             s3.Bucket(s3_bucket).download_file(s3_key, filename)
@@ -77,7 +296,14 @@ def download_file(s3, s3_bucket, s3_key, filename):
             print(e)
             return None
         try:
-            df = pd.read_csv(obj['Body'])
+            if column_info is None:
+                df = pd.read_csv(obj['Body'])
+            else:
+                # the pyarrow engine parses the file in many threads, with types known up front
+                dtype, parse_dates = get_csv_dtypes(column_info)
+                df = pd.read_csv(io.BytesIO(obj['Body'].read()), engine='pyarrow', dtype=dtype,
+                                 parse_dates=parse_dates)
+                df = convert_types(df, column_info)
         except ValueError as e:
             print('Something went wrong with query output formatting. Error message:')
             print(e)
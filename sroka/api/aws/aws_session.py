@@ -0,0 +1,124 @@
+import threading
+
+import boto3
+from botocore.config import Config
+from pyarrow import fs as arrow_fs
+
+import sroka.config.config as config
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# boto3 sessions and clients are expensive to build (botocore loaders, endpoint
+# resolution), so they are created once per credentials and region and shared.
+# Clients are thread-safe and shared between threads, resources are not, so they
+# are kept per thread.
+_sessions = {}
+_clients = {}
+_filesystems = {}
+_bucket_regions = {}
+_lock = threading.Lock()
+_local = threading.local()
+_state = {'generation': 0, 'max_pool_connections': None}
+
+
+def _get_max_pool_connections():
+    if _state['max_pool_connections'] is not None:
+        return _state['max_pool_connections']
+    if config.has_value('aws', 'max_pool_connections'):
+        return int(config.get_value('aws', 'max_pool_connections'))
+    return DEFAULT_MAX_POOL_CONNECTIONS
+
+
+def set_max_pool_connections(max_pool_connections):
+    """Sets size of the connection pool of every client and drops already created ones."""
+    if not isinstance(max_pool_connections, int) or max_pool_connections < 1:
+        raise ValueError('max_pool_connections must be a positive integer')
+    _state['max_pool_connections'] = max_pool_connections
+    invalidate()
+
+
+def get_session(key_id, access_key):
+    """Returns boto3 Session shared by all callers using the same credentials."""
+    session_key = (key_id, access_key)
+    with _lock:
+        session = _sessions.get(session_key)
+        if session is None:
+            session = boto3.Session(
+                aws_access_key_id=key_id,
+                aws_secret_access_key=access_key
+            )
+            _sessions[session_key] = session
+        return session
+
+
+def get_client(service_name, key_id, access_key, region=None):
+    """Returns boto3 client shared by all threads using the same credentials and region."""
+    client_key = (service_name, key_id, access_key, region)
+    session = get_session(key_id, access_key)
+    with _lock:
+        client = _clients.get(client_key)
+    if client is not None:
+        return client
+    client_config = Config(max_pool_connections=_get_max_pool_connections())
+    with _lock:
+        client = _clients.get(client_key)
+        if client is None:
+            client = session.client(service_name, region_name=region, config=client_config)
+            _clients[client_key] = client
+        return client
+
+
+def get_resource(service_name, key_id, access_key, region=None):
+    """Returns boto3 resource cached for the current thread, credentials and region."""
+    if getattr(_local, 'generation', None) != _state['generation']:
+        _local.generation = _state['generation']
+        _local.resources = {}
+    resource_key = (service_name, key_id, access_key, region)
+    resource = _local.resources.get(resource_key)
+    if resource is None:
+        session = get_session(key_id, access_key)
+        resource_config = Config(max_pool_connections=_get_max_pool_connections())
+        with _lock:
+            resource = session.resource(service_name, region_name=region, config=resource_config)
+        _local.resources[resource_key] = resource
+    return resource
+
+
+def _resolve_bucket_region(bucket):
+    # pyarrow does not follow redirects to the region of a bucket, so it is
+    # looked up once per bucket. Failed lookups are remembered as None, i.e.
+    # the default region of pyarrow.
+    with _lock:
+        if bucket in _bucket_regions:
+            return _bucket_regions[bucket]
+    try:
+        region = arrow_fs.resolve_s3_region(bucket)
+    except (OSError, ValueError) as error:
+        print('Unable to resolve region of bucket {}: {}'.format(bucket, error))
+        region = None
+    with _lock:
+        _bucket_regions[bucket] = region
+    return region
+
+
+def get_arrow_filesystem(key_id, access_key, bucket):
+    """Returns pyarrow S3FileSystem for the region of bucket, shared by all callers using the same credentials
+    and region."""
+    region = _resolve_bucket_region(bucket)
+    filesystem_key = (key_id, access_key, region)
+    with _lock:
+        filesystem = _filesystems.get(filesystem_key)
+        if filesystem is None:
+            filesystem = arrow_fs.S3FileSystem(access_key=key_id, secret_key=access_key, region=region)
+            _filesystems[filesystem_key] = filesystem
+        return filesystem
+
+
+def invalidate(key_id=None):
+    """Drops cached sessions, clients and resources - all of them or only those using given access key id."""
+    with _lock:
+        for cache in (_sessions, _clients, _filesystems):
+            for cache_key in list(cache):
+                if key_id is None or key_id in cache_key:
+                    del cache[cache_key]
+        _state['generation'] += 1
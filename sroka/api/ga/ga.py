@@ -1,19 +1,59 @@
+import datetime
+import itertools
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from typing import Dict
 
+import httplib2
 import pandas as pd
 from google.auth.exceptions import RefreshError
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 
 import sroka.config.config as config
+from sroka.dates.date_windows import split_into_windows
+
+# Number of seconds for which GA credentials, with access to a profile checked, are reused.
+GA_ACCESS_TTL = 60 * 60
+
+_ga_access_cache = {}
+_thread_http = threading.local()
+_thread_services = threading.local()
+
+# Dimensions holding dates, with their formats. Other dimensions are returned by GA as strings.
+DATE_DIMENSION_FORMATS = {
+    'ga:date': '%Y%m%d',
+    'ga:dateHour': '%Y%m%d%H',
+    'ga:dateHourMinute': '%Y%m%d%H%M',
+    'ga:yearMonth': '%Y%m',
+}
+
+# Dimensions holding numbers.
+INTEGER_DIMENSIONS = {'ga:year', 'ga:month', 'ga:week', 'ga:day', 'ga:hour', 'ga:minute', 'ga:dayOfWeek',
+                      'ga:isoWeek', 'ga:isoYear', 'ga:nthMinute', 'ga:nthHour', 'ga:nthDay', 'ga:nthWeek',
+                      'ga:nthMonth', 'ga:sessionCount', 'ga:daysSinceLastSession', 'ga:sessionDurationBucket'}
+
+# Metrics which cannot be summed over date ranges, besides averages, ratios and percentages.
+NON_ADDITIVE_METRICS = {'ga:users', 'ga:1dayUsers', 'ga:7dayUsers', 'ga:14dayUsers', 'ga:28dayUsers',
+                        'ga:30dayUsers'}
 
 
 class GADataNotYetAvailable(Exception):
     pass
 
 
+def clear_ga_access_cache():
+    """
+    Forgets all GA credentials, so the next request builds a new service and checks access to a profile again.
+    """
+    _ga_access_cache.clear()
+
+
 @contextmanager
 def __ga_access(input_dict):
     """
@@ -23,23 +63,30 @@ def __ga_access(input_dict):
     :param input_dict: request parameters - for validation
     :return: service
     """
-    # Authenticate and construct service.
+    # Authenticate and construct service, reusing credentials already validated.
     scope = 'https://www.googleapis.com/auth/analytics.readonly'
     key_file_location = config.get_file_path('google_analytics')
     authorized_user_file = os.path.expanduser('~/.cache/google_analytics.json')
 
-    credentials = config.set_google_credentials(authorized_user_file,
-                                                key_file_location,
-                                                scope)
+    cache_key = (key_file_location, authorized_user_file)
+    cached_access = _ga_access_cache.get(cache_key)
+    if cached_access is not None and time.monotonic() - cached_access['validated_at'] < GA_ACCESS_TTL:
+        credentials = cached_access['credentials']
+    else:
+        cached_access = None
+        credentials = config.set_google_credentials(authorized_user_file,
+                                                    key_file_location,
+                                                    scope)
 
-    service = discovery.build('analytics', 'v3', credentials=credentials)
+    service = __thread_service(cache_key, credentials)
     try:
-        first_profile_id = get_first_profile_id(service)
-        if not first_profile_id:
-            print('Could not find a valid profile for this user.')
-            return pd.DataFrame([])
-        else:
-            yield service
+        if cached_access is None:
+            first_profile_id = get_first_profile_id(service)
+            if not first_profile_id:
+                print('Could not find a valid profile for this user.')
+                return pd.DataFrame([])
+            _ga_access_cache[cache_key] = {'credentials': credentials, 'validated_at': time.monotonic()}
+        yield service
     except TypeError as error:
         # Handle errors in constructing a query.
         print(('There was an error in constructing your query : {}'.format(error)))
@@ -52,6 +99,7 @@ def __ga_access(input_dict):
 
     except RefreshError as error:
         # Handle Auth errors.
+        _ga_access_cache.pop(cache_key, None)
         print('The credentials have been revoked or expired, please re-run '
               'the application to re-authorize' + str(error))
         raise
@@ -76,6 +124,17 @@ def __ga_access(input_dict):
         print(('There was an error while handling the request: {}'.format(error)))
 
 
+def __thread_service(cache_key, credentials):
+    # a service uses a single httplib2 connection, which is not thread-safe, so every thread builds its own
+    services = getattr(_thread_services, 'services', None)
+    if services is None:
+        services = _thread_services.services = {}
+    service = services.get(cache_key)
+    if service is None or service._http.credentials is not credentials:
+        service = services[cache_key] = discovery.build('analytics', 'v3', credentials=credentials)
+    return service
+
+
 def get_first_profile_id(service):
 
     accounts = service.management().accounts().list().execute()
@@ -152,14 +211,7 @@ def ga_request(input_dict, print_sample_size=False, sampling_level='HIGHER_PRECI
         with __ga_access(input_dict) as service:
             input_dict['sampling_level'] = sampling_level
             results = get_top_keywords(service, input_dict)
-            columns = results['query']['dimensions'].split(',') + results['query']['metrics']
-            df = pd.DataFrame(results['rows'], columns=columns)
-
-            for column in df.columns:
-                try:
-                    df[column] = pd.to_numeric(df[column])
-                except ValueError:
-                    pass
+            df = __results_to_frame(results['rows'], results)
             df.columns = [x[3:] for x in list(df.columns)]
 
             __print_sample_size(print_sample_size, results)
@@ -177,7 +229,9 @@ def ga_request_all_data(
         page_size: int = 10000,
         max_pages: int = None,
         print_sample_size: bool = False,
-        sampling_level: str = 'HIGHER_PRECISION'):
+        sampling_level: str = 'HIGHER_PRECISION',
+        parallelism: int = 4,
+        max_retries: int = 5):
     """
     Retrieves all available data from GA using pagination.
     Raises a GADataNotYetAvailable exception if there are no rows in the GA response.
@@ -199,6 +253,12 @@ def ga_request_all_data(
     :param sampling_level:
         the GA sampling level (optional, default = HIGHER_PRECISION, valid values: 'DEFAULT', 'FASTER',
         'HIGHER_PRECISION')
+    :param parallelism:
+        the number of pages requested at the same time, after the first one (integer, optional, default = 4,
+        min value = 1)
+    :param max_retries:
+        the number of retries of a page request failed because of rate limits, quota or server errors
+        (integer, optional, default = 5, min value = 0)
 
     :return: a Pandas data frame
     """
@@ -232,42 +292,214 @@ def ga_request_all_data(
         print('sampling_level has three valid values: DEFAULT, FASTER, HIGHER_PRECISION')
         return pd.DataFrame([])
 
+    if not isinstance(parallelism, int) or parallelism < 1:
+        print('parallelism={}'.format(parallelism))
+        print('parallelism must be an integer. The minimal value is 1.')
+        return pd.DataFrame([])
+
+    if not isinstance(max_retries, int) or max_retries < 0:
+        print('max_retries={}'.format(max_retries))
+        print('max_retries must be a non-negative integer.')
+        return pd.DataFrame([])
+
     with __ga_access(input_dict) as service:
         if 'start_index' in input_dict.keys() or 'max_results' in input_dict.keys():
             print('This function overwrites start_index and max_results parameters! ' +
                   'Do not include them in the input_dict parameter.')
         input_dict = dict(input_dict)
+        input_dict.pop('start_index', None)
         input_dict['max_results'] = page_size
         input_dict['samplingLevel'] = sampling_level
 
-        all_rows = []
-        fetched_rows_count = page_size
-        current_index = start_index
-        number_of_retrieved_pages = 0
-        results = None
-        is_first_page = True
-        while fetched_rows_count == page_size and (max_pages is None or number_of_retrieved_pages < max_pages):
-            input_dict['start_index'] = current_index
-            results = service.data().ga().get(**input_dict).execute()
-            if 'rows' not in results and is_first_page:
-                raise GADataNotYetAvailable('There were no rows in the GA response!')
-            elif 'rows' not in results:
-                # special case for the number of available rows equal to a multiple of the page size
-                break
-
-            rows = results['rows']
-            fetched_rows_count = len(rows)
-            current_index += fetched_rows_count
-            all_rows = all_rows + rows
-            number_of_retrieved_pages += 1
-            is_first_page = False
+        # the first page tells how many rows there are, so the other pages can be requested at once
+        results = __ga_get_page(service, input_dict, start_index, max_retries)
+        if 'rows' not in results:
+            raise GADataNotYetAvailable('There were no rows in the GA response!')
+        __print_sample_size(print_sample_size, results)
+
+        total_results = int(results['totalResults'])
+        number_of_pages = -(-(total_results - start_index + 1) // page_size)
+        if max_pages is not None:
+            number_of_pages = min(number_of_pages, max_pages)
+        page_indexes = [start_index + page * page_size for page in range(1, number_of_pages)]
+
+        pages = [results['rows']]
+        fetched_rows_count = len(results['rows'])
+        print('fetched {} of {} rows'.format(fetched_rows_count, total_results))
+        if len(results['rows']) == page_size and page_indexes:
+            def get_page(index):
+                return __ga_get_page(service, input_dict, index, max_retries, __thread_http(service))
+
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                for page_results in executor.map(get_page, page_indexes):
+                    if 'rows' not in page_results:
+                        # special case for the number of available rows equal to a multiple of the page size
+                        break
+                    pages.append(page_results['rows'])
+                    fetched_rows_count += len(page_results['rows'])
+                    __print_sample_size(print_sample_size, page_results)
+                    print('fetched {} of {} rows'.format(fetched_rows_count, total_results))
+
+        return __results_to_frame(list(itertools.chain.from_iterable(pages)), results)
+
+
+def __results_to_frame(rows, results):
+    columns = results['query']['dimensions'].split(',') + results['query']['metrics']
+    columns = [x.strip() for x in columns]
+    df = pd.DataFrame(rows, columns=columns)
+    for header in results.get('columnHeaders', []):
+        df[header['name']] = __coerce_column(df[header['name']], header)
+    return df
+
+
+def __coerce_column(column, header):
+    # converts a column of strings in a single pass, based on columnHeaders metadata of the response
+    name = header['name']
+    try:
+        if name in DATE_DIMENSION_FORMATS:
+            return pd.to_datetime(column, format=DATE_DIMENSION_FORMATS[name])
+        if header.get('dataType') == 'INTEGER' or name in INTEGER_DIMENSIONS:
+            return column.astype('int64')
+        if header.get('dataType') in ('FLOAT', 'PERCENT', 'TIME', 'CURRENCY'):
+            return column.astype('float64')
+    except (ValueError, TypeError):
+        if name in DATE_DIMENSION_FORMATS:
+            return column
+        # e.g. '(other)' values, which become NaN
+        return pd.to_numeric(column, errors='coerce')
+    return column
+
+
+def __thread_http(service):
+    # httplib2 connections are not thread-safe, so every thread uses its own one
+    credentials = service._http.credentials
+    if getattr(_thread_http, 'credentials', None) is not credentials:
+        _thread_http.credentials = credentials
+        _thread_http.connection = AuthorizedHttp(credentials, http=httplib2.Http())
+    return _thread_http.connection
+
+
+def __ga_get_page(service, input_dict, start_index, max_retries, http=None):
+    # rate limit and quota errors are retried by the client with exponential backoff
+    return service.data().ga().get(start_index=start_index, **input_dict).execute(http=http,
+                                                                                  num_retries=max_retries)
+
+
+def __resolve_date(value):
+    # GA accepts YYYY-MM-DD dates and relative ones: today, yesterday and NdaysAgo
+    if value == 'today':
+        return datetime.date.today()
+    if value == 'yesterday':
+        return datetime.date.today() - datetime.timedelta(days=1)
+    days_ago = re.fullmatch(r'(\d+)daysAgo', value)
+    if days_ago:
+        return datetime.date.today() - datetime.timedelta(days=int(days_ago.group(1)))
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def split_date_range(start_date, end_date, shard_by='month'):
+    """
+    Splits a GA date range into day, week (Monday to Sunday) or month windows.
+
+    :return: a list of (start_date, end_date) tuples of YYYY-MM-DD strings
+    """
+    return [(start.isoformat(), end.isoformat())
+            for start, end in split_into_windows(__resolve_date(start_date), __resolve_date(end_date), shard_by)]
 
-            __print_sample_size(print_sample_size, results)
-            print('fetched {} of {} rows'.format(current_index - 1, results["totalResults"]))
 
-        if not results or not all_rows:
-            return pd.DataFrame([])
+def __is_additive(header):
+    name = header['name']
+    return (header.get('dataType') in ('INTEGER', 'CURRENCY', 'TIME') and name not in NON_ADDITIVE_METRICS and
+            not name.startswith('ga:avg') and 'Per' not in name)
+
+
+def __get_shard(service, input_dict, max_retries):
+    # all pages of a single shard, requested one by one
+    rows = []
+    start_index = 1
+    while True:
+        results = __ga_get_page(service, input_dict, start_index, max_retries, __thread_http(service))
+        rows.extend(results.get('rows', []))
+        start_index += len(results.get('rows', []))
+        if not results.get('rows') or start_index > int(results['totalResults']):
+            return rows, results
+
+
+def ga_request_sharded(input_dict, shard_by='month', max_workers=4, print_sample_size=False,
+                       sampling_level='HIGHER_PRECISION', max_retries=5):
+    """
+    Splits the date range of a GA request into day, week or month shards, requests them concurrently and merges
+    the results. Smaller date ranges are less likely to be sampled.
+
+    Rows with the same dimension values in different shards are merged by summing additive metrics (counts,
+    currency and durations). Other metrics (averages, ratios, percentages, users) cannot be merged and are dropped
+    in that case - add ga:date (or a coarser date dimension) to keep them.
+    Shards which were still sampled are printed and listed in df.attrs['sampled_shards'].
+
+    :param input_dict: the dictionary of GA request parameters
+    :param shard_by: 'day', 'week' or 'month' (optional, default = 'month')
+    :param max_workers: the number of shards requested at the same time (optional, default = 4)
+    :param print_sample_size: if True, prints the sample size of every shard (optional, default = False)
+    :param sampling_level: the GA sampling level (optional, default = HIGHER_PRECISION)
+    :param max_retries: the number of retries of a request failed because of rate limits, quota or server errors
+    :return: a Pandas data frame
+    """
+    try:
+        shards = split_date_range(input_dict['start_date'], input_dict['end_date'], shard_by)
+    except (KeyError, ValueError) as error:
+        print('There was an error in the date range of your query: {}'.format(error))
+        return pd.DataFrame([])
+
+    try:
+        with __ga_access(input_dict) as service:
+            request = {key: value for key, value in input_dict.items()
+                       if value != '' and key not in ('start_index', 'max_results', 'sampling_level')}
+            request['max_results'] = 10000
+            request['samplingLevel'] = sampling_level
+
+            def get_shard(shard):
+                return __get_shard(service, dict(request, start_date=shard[0], end_date=shard[1]), max_retries)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                shard_results = list(executor.map(get_shard, shards))
+
+            frames = []
+            sampled_shards = []
+            for shard, (rows, results) in zip(shards, shard_results):
+                if results.get('containsSampledData'):
+                    sample_size = round(int(results['sampleSize']) / int(results['sampleSpace']) * 100, 2)
+                    sampled_shards.append((shard[0], shard[1], sample_size))
+                if print_sample_size:
+                    print('{} - {}:'.format(*shard), end=' ')
+                    __print_sample_size(print_sample_size, results)
+                if rows:
+                    frames.append(__results_to_frame(rows, results))
+
+            if not frames:
+                print('Your query did not return any rows.')
+                return pd.DataFrame([])
+
+            df = pd.concat(frames, ignore_index=True)
+            headers = shard_results[0][1]['columnHeaders']
+            dimensions = [header['name'] for header in headers if header.get('columnType') == 'DIMENSION']
+            if dimensions and df.duplicated(dimensions).any():
+                additive = [header['name'] for header in headers
+                            if header.get('columnType') == 'METRIC' and __is_additive(header)]
+                dropped = [header['name'] for header in headers
+                           if header.get('columnType') == 'METRIC' and not __is_additive(header)]
+                if dropped:
+                    print('Metrics which cannot be summed over shards were dropped: {}'.format(', '.join(dropped)))
+                df = df.groupby(dimensions, as_index=False, sort=False)[additive].sum()
+            elif not dimensions and len(df) > 1:
+                additive = [header['name'] for header in headers if __is_additive(header)]
+                df = df[additive].sum().to_frame().T
+
+            for start, end, sample_size in sampled_shards:
+                print('Shard {} - {} is sampled, sample size {} %'.format(start, end, sample_size))
 
-        columns = results['query']['dimensions'].split(',') + results['query']['metrics']
-        columns = [x.strip() for x in columns]
-        return pd.DataFrame(all_rows, columns=columns)
+            df.columns = [x[3:] for x in list(df.columns)]
+            df.attrs['sampled_shards'] = sampled_shards
+            return df
+    except Exception:
+        # the error message is displayed by context manager
+        return pd.DataFrame([])
@@ -1,23 +1,35 @@
-import gzip
 import json
-import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import NoOptionError
 
 import pandas as pd
 from googleads import ad_manager, errors
+from retrying import retry
 from zeep import helpers
+from zeep.xsd import ComplexType, CompoundValue
 
 import sroka.config.config as config
+from sroka.api.google_ad_manager.gam_report import (concat_report_tables,
+                                                    date_to_dict,
+                                                    download_report,
+                                                    iter_report_chunks,
+                                                    read_report,
+                                                    read_report_table,
+                                                    split_date_range)
 
 # import variable_validators as validator
 
 KEY_FILE = config.get_file_path('google_ad_manager')
 
-# GAM API information.
-try:
-    APPLICATION_NAME = config.get_value('google_ad_manager', 'application_name')
-except (KeyError, NoOptionError):
-    APPLICATION_NAME = 'Application name'
+# Errors after which a request is retried with exponential backoff.
+QUOTA_ERRORS = ('QuotaError.EXCEEDED_QUOTA', 'QuotaError.REPORT_JOB_LIMIT', 'ServerError.SERVER_BUSY')
+# Number of report jobs run at the same time by get_sharded_data_from_admanager.
+DEFAULT_MAX_CONCURRENT_REPORTS = 4
+
+# Key paths of columns to keep, by object type and columns.
+_key_paths = {}
 
 
 def dict_type_checker(dict_argument, argument_name, mandatory=True):
@@ -64,6 +76,14 @@ def str_type_checker(str_argument, argument_name, mandatory=True):
             return "Incorrect type"
 
 
+def get_application_name():
+    # read when connecting rather than on import, so the module can be imported without a config file
+    try:
+        return config.get_value('google_ad_manager', 'application_name')
+    except (KeyError, NoOptionError):
+        return 'Application name'
+
+
 def init_gam_connection(network_code=None):
     if not network_code:
         try:
@@ -72,7 +92,7 @@ def init_gam_connection(network_code=None):
             print('No network code was provided')
             return pd.DataFrame([])
     yaml_string = "ad_manager: " + "\n" + \
-                  "  application_name: " + APPLICATION_NAME + "\n" + \
+                  "  application_name: " + get_application_name() + "\n" + \
                   "  network_code: " + str(network_code) + "\n" + \
                   "  path_to_private_key_file: " + KEY_FILE + "\n"
 
@@ -81,34 +101,13 @@ def init_gam_connection(network_code=None):
     return gam_client
 
 
-def get_data_from_admanager(query, dimensions, columns, start_date, end_date, custom_field_id=None,
-                            dimension_attributes=None, network_code=None):
-    if not custom_field_id:
-        custom_field_id = []
-
-    if not dimension_attributes:
-        dimension_attributes = []
-
-    list_of_types = [str_type_checker(query, "query"),
-                     list_type_checker(dimensions, "dimensions"),
-                     list_type_checker(columns, "columns"),
-                     dict_type_checker(start_date, "start_date"),
-                     dict_type_checker(end_date, "end_date"),
-                     list_type_checker(custom_field_id, "custom_field_id", False),
-                     list_type_checker(dimension_attributes, "dimmension_attributes", False),
-                     int_type_checker(network_code, "network_code", False)]
-
-    if "Incorrect type" in list_of_types:
-        return
-
-    gam_client = init_gam_connection(network_code)
-
+def build_report_job(query, dimensions, columns, start_date, end_date, custom_field_id, dimension_attributes):
     # Create statement object to filter for an order.
 
     filter_statement = {'query': query}
 
     # Create report job.
-    report_job = {
+    return {
         'reportQuery': {
             'dimensions': dimensions,
             'statement': filter_statement,
@@ -122,11 +121,11 @@ def get_data_from_admanager(query, dimensions, columns, start_date, end_date, cu
         }
     }
 
-    report_downloader = gam_client.GetDataDownloader()
 
+def run_report(report_downloader, report_job, max_retries=0):
+    """Runs the report job and waits for it to finish. Returns its id, or None if it failed."""
     try:
-        # Run the report and wait for it to finish.
-        report_job_id = report_downloader.WaitForReport(report_job)
+        return with_quota_retries(report_downloader.WaitForReport, max_retries)(report_job)
     except errors.GoogleAdsServerFault as e:
         if 'AuthenticationError.NETWORK_NOT_FOUND' in str(e):
             print('Provided network code was not found.')
@@ -140,35 +139,166 @@ def get_data_from_admanager(query, dimensions, columns, start_date, end_date, cu
         print('Failed to generate report. Error was: {}'.format(e))
         return
 
-    export_format = 'CSV_DUMP'
 
-    report_file = tempfile.NamedTemporaryFile(suffix='.csv.gz', delete=False)
+def get_data_from_admanager(query, dimensions, columns, start_date, end_date, custom_field_id=None,
+                            dimension_attributes=None, network_code=None, chunksize=None):
+    if not custom_field_id:
+        custom_field_id = []
+
+    if not dimension_attributes:
+        dimension_attributes = []
+
+    list_of_types = [str_type_checker(query, "query"),
+                     list_type_checker(dimensions, "dimensions"),
+                     list_type_checker(columns, "columns"),
+                     dict_type_checker(start_date, "start_date"),
+                     dict_type_checker(end_date, "end_date"),
+                     list_type_checker(custom_field_id, "custom_field_id", False),
+                     list_type_checker(dimension_attributes, "dimmension_attributes", False),
+                     int_type_checker(network_code, "network_code", False),
+                     int_type_checker(chunksize, "chunksize", False)]
+
+    if "Incorrect type" in list_of_types:
+        return
+
+    gam_client = init_gam_connection(network_code)
+
+    report_job = build_report_job(query, dimensions, columns, start_date, end_date, custom_field_id,
+                                  dimension_attributes)
 
-    # Download report data.
-    report_downloader.DownloadReportToFile(
-        report_job_id, export_format, report_file, use_gzip_compression=True)
+    report_downloader = gam_client.GetDataDownloader()
 
-    report_file.close()
+    report_job_id = run_report(report_downloader, report_job)
+    if report_job_id is None:
+        return
 
-    # Display results.
-    print('Report job with id {} downloaded to:\n{}'.format(
-        report_job_id, report_file.name))
-    with gzip.open(report_file.name) as file:
-        data = pd.read_csv(file)
-    return data
+    # Download report data, decompressing it on the fly.
+    report_file = download_report(report_downloader, report_job_id)
+    if chunksize:
+        return iter_report_chunks(report_file, chunksize)
+    with report_file:
+        return read_report(report_file)
 
 
-def get_users_from_admanager(query, dimensions, network_code=None):
+def get_sharded_data_from_admanager(query, dimensions, columns, start_date, end_date, shard_by='month',
+                                    max_concurrent_reports=DEFAULT_MAX_CONCURRENT_REPORTS, custom_field_id=None,
+                                    dimension_attributes=None, network_code=None, max_retries=5):
+    """
+    Splits the date range of a report into day, week or month shards, runs a report job for every shard,
+    at most max_concurrent_reports at the same time, and concatenates their results in date order.
+
+    Every report is downloaded as soon as its job is completed. Report jobs rejected because of the limit of
+    report jobs of the network are retried with exponential backoff. Rows of different shards are not merged,
+    so dimensions should include DATE (or a coarser date dimension). Time of every report job is printed and
+    stored in df.attrs['report_timings'].
+
+    :return: a Pandas data frame, or None if any report job failed
+    """
+    if not custom_field_id:
+        custom_field_id = []
+
+    if not dimension_attributes:
+        dimension_attributes = []
+
     list_of_types = [str_type_checker(query, "query"),
                      list_type_checker(dimensions, "dimensions"),
+                     list_type_checker(columns, "columns"),
+                     dict_type_checker(start_date, "start_date"),
+                     dict_type_checker(end_date, "end_date"),
+                     str_type_checker(shard_by, "shard_by"),
+                     int_type_checker(max_concurrent_reports, "max_concurrent_reports"),
+                     list_type_checker(custom_field_id, "custom_field_id", False),
+                     list_type_checker(dimension_attributes, "dimmension_attributes", False),
                      int_type_checker(network_code, "network_code", False)]
 
     if "Incorrect type" in list_of_types:
         return
 
-    user_df = pd.DataFrame()
+    try:
+        shards = split_date_range(start_date, end_date, shard_by)
+    except (KeyError, TypeError, ValueError) as e:
+        print('There was an error in the date range of your report: {}'.format(e))
+        return
+
+    gam_client = init_gam_connection(network_code)
+
+    def run_shard(shard):
+        started = time.monotonic()
+        # data downloaders are not shared between threads
+        report_downloader = gam_client.GetDataDownloader()
+        report_job = build_report_job(query, dimensions, columns, date_to_dict(shard[0]), date_to_dict(shard[1]),
+                                      custom_field_id, dimension_attributes)
+        report_job_id = run_report(report_downloader, report_job, max_retries)
+        if report_job_id is None:
+            return None, None
+        completed = time.monotonic()
+        with download_report(report_downloader, report_job_id) as report_file:
+            table = read_report_table(report_file)
+        timing = {'start_date': shard[0].isoformat(), 'end_date': shard[1].isoformat(),
+                  'report_job_id': report_job_id, 'rows': table.num_rows,
+                  'report_seconds': round(completed - started, 1),
+                  'download_seconds': round(time.monotonic() - completed, 1)}
+        print('{start_date} - {end_date}: report job {report_job_id} took {report_seconds} s, '
+              'download of {rows} rows {download_seconds} s'.format(**timing))
+        return table, timing
+
+    def run_shard_safely(shard):
+        # an error of one shard is reported with its date range and does not stop the other shards
+        try:
+            return run_shard(shard)
+        except Exception as e:
+            print('Report for {} - {} failed. Error was: {}'.format(shard[0].isoformat(), shard[1].isoformat(), e))
+            return None, None
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrent_reports) as executor:
+        shard_results = list(executor.map(run_shard_safely, shards))
+    elapsed = time.monotonic() - started
+
+    failed_shards = [shard for shard, (table, _) in zip(shards, shard_results) if table is None]
+    if failed_shards:
+        print('Reports for these date ranges failed: {}'.format(
+            ', '.join('{} - {}'.format(start.isoformat(), end.isoformat()) for start, end in failed_shards)))
+        return
 
-    dimensions_df = pd.DataFrame()
+    timings = pd.DataFrame([timing for _, timing in shard_results])
+    print('{} report jobs took {:.1f} s in total, {:.1f} s of wall-clock time'.format(
+        len(shards), (timings['report_seconds'] + timings['download_seconds']).sum(), elapsed))
+    df = concat_report_tables([table for table, _ in shard_results]).to_pandas()
+    df.attrs['report_timings'] = timings
+    return df
+
+
+def fetch_all_pages(fetch_method, statement):
+    """Yields lists of entities returned by a getXByStatement method, moving statement offset
+    until an empty page is returned."""
+    while True:
+        response = fetch_method(statement.ToStatement())
+        if 'results' in response and len(response['results']):
+            yield response['results']
+            statement.offset += statement.limit
+        else:
+            break
+
+
+def get_dimensions_from_admanager(fetch_method, statement, dimensions):
+    """Returns DataFrame with given dimensions of all entities matching the statement.
+
+    Values are collected in a list and the DataFrame is built once, so time grows linearly with the number
+    of entities. Raises KeyError if an entity has no such dimension."""
+    rows = []
+    for entities in fetch_all_pages(fetch_method, statement):
+        rows.extend([entity[dimension] for dimension in dimensions] for entity in entities)
+    return pd.DataFrame(rows, columns=dimensions)
+
+
+def get_users_from_admanager(query, dimensions, network_code=None):
+    list_of_types = [str_type_checker(query, "query"),
+                     list_type_checker(dimensions, "dimensions"),
+                     int_type_checker(network_code, "network_code", False)]
+
+    if "Incorrect type" in list_of_types:
+        return
 
     # .Where() handles filtering with admanager method, while statement_query handles queries with WHERE clause
 
@@ -181,24 +311,11 @@ def get_users_from_admanager(query, dimensions, network_code=None):
     user_service = gam_client.GetService('UserService')
 
     try:
-        while True:
-            response = user_service.getUsersByStatement(statement.ToStatement())
-            if 'results' in response and len(response['results']):
-                for user in response['results']:
-
-                    for dimension in dimensions:
-                        try:
-                            dimension_value = [user[dimension]]
-                            dimensions_df[dimension] = dimension_value
-                        except KeyError as e:
-                            print('Failed to generate user list. Incorrect dimension: {}'.format(e))
-                            return
-
-                    user_df = pd.concat([user_df, dimensions_df], sort=False)
-                statement.offset += statement.limit
-            else:
-                break
-        return user_df
+        return get_dimensions_from_admanager(user_service.getUsersByStatement, statement, dimensions)
+
+    except KeyError as e:
+        print('Failed to generate user list. Incorrect dimension: {}'.format(e))
+        return
 
     except errors.GoogleAdsServerFault as e:
         if 'AuthenticationError.NETWORK_NOT_FOUND' in str(e):
@@ -222,10 +339,6 @@ def get_companies_from_admanager(query, dimensions, network_code=None):
     if "Incorrect type" in list_of_types:
         return
 
-    company_df = pd.DataFrame()
-
-    dimensions_df = pd.DataFrame()
-
     # .Where() handles filtering with admanager method, while statement_query handles queries with WHERE clause
 
     statement_query = query.upper().replace("WHERE ", "")
@@ -237,24 +350,11 @@ def get_companies_from_admanager(query, dimensions, network_code=None):
     company_service = gam_client.GetService('CompanyService')
 
     try:
-        while True:
-            response = company_service.getCompaniesByStatement(statement.ToStatement())
-            if 'results' in response and len(response['results']):
-                for company in response['results']:
-
-                    for dimension in dimensions:
-                        try:
-                            dimension_value = [company[dimension]]
-                            dimensions_df[dimension] = dimension_value
-                        except KeyError as e:
-                            print('Failed to generate company list. Incorrect dimension: {}'.format(e))
-                            return
-
-                    company_df = pd.concat([company_df, dimensions_df], sort=False)
-                statement.offset += statement.limit
-            else:
-                break
-        return company_df
+        return get_dimensions_from_admanager(company_service.getCompaniesByStatement, statement, dimensions)
+
+    except KeyError as e:
+        print('Failed to generate company list. Incorrect dimension: {}'.format(e))
+        return
 
     except errors.GoogleAdsServerFault as e:
         if 'AuthenticationError.NETWORK_NOT_FOUND' in str(e):
@@ -270,11 +370,65 @@ def get_companies_from_admanager(query, dimensions, network_code=None):
         return
 
 
+def flatten_list(values: list):
+    """Joins a list into a single value: JSON for a list of objects, comma separated values otherwise."""
+    if values and all(isinstance(value, dict) for value in values):
+        return json.dumps(values)
+    return ','.join(map(str, values))
+
+
+def resolve_key_path(xsd_type, column: str, sep: str = '_') -> tuple:
+    """
+    Splits a flattened column name into the names of nested elements, following
+    the elements of a zeep type, so that element names containing the separator
+    are split correctly. Parts not found in the schema (e.g. elements of a subtype)
+    are split on the separator.
+    """
+    if isinstance(xsd_type, ComplexType):
+        for name, element in xsd_type.elements:
+            if column == name:
+                return (name,)
+            if column.startswith(name + sep) and isinstance(element.type, ComplexType):
+                return (name,) + resolve_key_path(element.type, column[len(name) + len(sep):], sep)
+    return tuple(column.split(sep))
+
+
+def get_key_paths(obj: object, columns_to_keep: list[str]) -> list:
+    """Returns (column, key path) pairs for objects of the type of obj, computed once per type and columns."""
+    cache_key = (type(obj), tuple(columns_to_keep))
+    if cache_key not in _key_paths:
+        xsd_type = getattr(obj, '_xsd_type', None)
+        _key_paths[cache_key] = [(column, resolve_key_path(xsd_type, column)) for column in columns_to_keep]
+    return _key_paths[cache_key]
+
+
+def get_flattened_value(obj: object, key_path: tuple):
+    """Returns the value which flattening obj would give for the key path, serializing only that value."""
+    value = obj
+    for key in key_path:
+        if isinstance(value, CompoundValue):
+            value = value.__values__.get(key)
+        elif isinstance(value, dict):
+            value = value.get(key)
+        else:
+            # a path through a list or a missing object is not a flattened key
+            return None
+    if isinstance(value, (CompoundValue, dict)):
+        return None
+    if isinstance(value, list):
+        return flatten_list(helpers.serialize_object(value, dict))
+    return value
+
+
 def serialize_gam_object(obj: object, columns_to_keep: list[str] = None) -> dict:
     """
     Serializes a zeep object from the GAM API into a flattened dictionary,
     handling nested objects and lists.
 
+    If columns_to_keep are provided, key paths of these columns are computed once
+    per zeep type and only their values are read, without serializing the rest
+    of the object.
+
     Args:
         obj: The zeep object to serialize.
         columns_to_keep: An optional list of column names to keep. If provided,
@@ -283,6 +437,9 @@ def serialize_gam_object(obj: object, columns_to_keep: list[str] = None) -> dict
     Returns:
         A flattened dictionary representation of the object.
     """
+    if columns_to_keep:
+        return {column: get_flattened_value(obj, key_path) for column, key_path in get_key_paths(obj, columns_to_keep)}
+
     base_dict = helpers.serialize_object(obj, dict)
 
     def flatten_dict(d: dict, parent_key: str = '', sep: str = '_') -> dict:
@@ -292,20 +449,64 @@ def serialize_gam_object(obj: object, columns_to_keep: list[str] = None) -> dict
             if isinstance(v, dict):
                 items.extend(flatten_dict(v, new_key, sep=sep).items())
             elif isinstance(v, list):
-                if v and all(isinstance(i, dict) for i in v):
-                    items.append((new_key, json.dumps(v)))
-                else:
-                    items.append((new_key, ','.join(map(str, v))))
+                items.append((new_key, flatten_list(v)))
             else:
                 items.append((new_key, v))
         return dict(items)
 
-    flattened_data = flatten_dict(base_dict)
+    return flatten_dict(base_dict)
+
+
+def is_quota_error(exception):
+    return isinstance(exception, errors.GoogleAdsServerFault) and any(
+        error in str(exception) for error in QUOTA_ERRORS)
+
+
+def with_quota_retries(function, max_retries):
+    """Wraps a GAM API call so that it is retried with exponential backoff on quota errors."""
+    return retry(retry_on_exception=is_quota_error,
+                 stop_max_attempt_number=max_retries + 1,
+                 wait_exponential_multiplier=1000,
+                 wait_exponential_max=60 * 1000)(function)
 
-    if columns_to_keep:
-        return {key: flattened_data.get(key) for key in columns_to_keep}
 
-    return flattened_data
+def fetch_page(fetch_method, statement, max_retries):
+    """Calls a getXByStatement method, retrying with exponential backoff on quota errors."""
+    return with_quota_retries(fetch_method, max_retries)(statement.ToStatement())
+
+
+def fetch_pages_concurrently(gam_client, service_name, method_name, fetch_method, statement, max_workers,
+                             max_retries):
+    """Fetches the first page of the statement to learn totalResultSetSize, then the remaining pages
+    in a thread pool.
+
+    Returns items of all pages in the order of their offsets."""
+    thread_services = threading.local()
+
+    def fetch_offset(offset):
+        # zeep clients are not shared between threads
+        if not hasattr(thread_services, 'fetch_method'):
+            thread_services.fetch_method = getattr(gam_client.GetService(service_name), method_name)
+        page_statement = ad_manager.FilterStatement(statement.where_clause, statement.values, statement.limit, offset)
+        response = fetch_page(thread_services.fetch_method, page_statement, max_retries)
+        results = response["results"] if response and "results" in response and response["results"] else []
+        print(f"-> Found {len(results)} items at offset {offset}.")
+        return results
+
+    first_page = fetch_page(fetch_method, statement, max_retries)
+    if not first_page or "results" not in first_page or not first_page["results"]:
+        print("No items found.")
+        return []
+    total = first_page["totalResultSetSize"]
+    offsets = range(statement.offset + statement.limit, total, statement.limit)
+    print(f"Fetching {total} items in {len(offsets) + 1} pages, {max_workers} at a time...")
+
+    all_items = list(first_page["results"])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map returns pages in the order of offsets, so items stay ordered by id
+        for results in executor.map(fetch_offset, offsets):
+            all_items.extend(results)
+    return all_items
 
 
 def get_service_data_from_admanager(
@@ -313,6 +514,8 @@ def get_service_data_from_admanager(
     query_filter: str = None,
     columns_to_keep: list[str] = None,
     network_code: str = None,
+    max_workers: int = 1,
+    max_retries: int = 5,
 ) -> pd.DataFrame:
     """
     Fetches a complete list of a specified service data type from Google Ad Manager.
@@ -321,6 +524,10 @@ def get_service_data_from_admanager(
     LineItemService). It handles pagination
     automatically to retrieve all entities matching the query.
 
+    With max_workers greater than 1, the first page tells the total number of
+    items and the remaining pages are fetched concurrently, each thread with
+    its own service. Items are returned in id order either way.
+
     Args:
         service: The type of service data to fetch. Must be a key in the service_map (e.g., 'AdUnit').
         query_filter: An optional PQL-like 'WHERE' clause to filter the results.
@@ -329,6 +536,9 @@ def get_service_data_from_admanager(
         columns_to_keep: An optional list of column names to keep in the output DataFrame.
                     If None, provides all the columns.
         network_code: The GAM network code to use.
+        max_workers: Number of pages fetched at the same time. 1 fetches them one by one.
+        max_retries: Number of times a page is fetched again after a quota error,
+                     with exponential backoff.
     Returns:
         A pandas DataFrame with all the items in the specified service data.
 
@@ -361,8 +571,8 @@ def get_service_data_from_admanager(
 
     try:
         gam_client = init_gam_connection(network_code)
-        service = gam_client.GetService(service_name)
-        fetch_method = getattr(service, method_name)
+        gam_service = gam_client.GetService(service_name)
+        fetch_method = getattr(gam_service, method_name)
     except Exception as e:
         print(
             f"Failed to initialize service '{service_name}' or method '{method_name}'."
@@ -379,30 +589,35 @@ def get_service_data_from_admanager(
     full_query = " ".join(query_parts)
     statement = ad_manager.FilterStatement(full_query)
 
-    all_items = []
-    page_number = 1
+    if max_workers > 1:
+        statement.limit = gam_api_page_limit
+        all_items = fetch_pages_concurrently(gam_client, service_name, method_name, fetch_method, statement,
+                                             max_workers, max_retries)
+    else:
+        all_items = []
+        page_number = 1
 
-    while True:
-        print(
-            f"Fetching page {page_number} (limit: {gam_api_page_limit}, offset: {statement.offset or 0})..."
-        )
+        while True:
+            print(
+                f"Fetching page {page_number} (limit: {gam_api_page_limit}, offset: {statement.offset or 0})..."
+            )
 
-        response = fetch_method(statement.ToStatement())
+            response = fetch_page(fetch_method, statement, max_retries)
 
-        if response and "results" in response and response["results"]:
-            num_results = len(response["results"])
-            print(f"-> Found {num_results} items on this page.")
+            if response and "results" in response and response["results"]:
+                num_results = len(response["results"])
+                print(f"-> Found {num_results} items on this page.")
 
-            all_items.extend(response["results"])
+                all_items.extend(response["results"])
 
-            statement.offset += gam_api_page_limit
-            page_number += 1
+                statement.offset += gam_api_page_limit
+                page_number += 1
 
-            if num_results < gam_api_page_limit:
+                if num_results < gam_api_page_limit:
+                    break
+            else:
+                print("No more items found.")
                 break
-        else:
-            print("No more items found.")
-            break
 
     print(
         f"Successfully fetched a total of {len(all_items)} '{service}' items.\n"
@@ -0,0 +1,132 @@
+import csv
+import datetime
+import tempfile
+import zlib
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from sroka.dates.date_windows import split_into_windows
+
+# Decompressed reports up to this size are kept in memory, larger ones are spilled to a temporary file.
+REPORT_SPOOL_MAX_BYTES = 256 * 1024 ** 2
+# Size of CSV blocks parsed by every thread.
+REPORT_BLOCK_SIZE = 16 * 1024 ** 2
+
+
+def date_to_dict(date):
+    return {'year': date.year, 'month': date.month, 'day': date.day}
+
+
+def split_date_range(start_date, end_date, shard_by='month'):
+    """
+    Splits a report date range, given as dicts with year, month and day, into day, week (Monday to Sunday)
+    or month windows.
+
+    :return: a list of (start date, end date) tuples of datetime.date objects
+    """
+    start = datetime.date(int(start_date['year']), int(start_date['month']), int(start_date['day']))
+    end = datetime.date(int(end_date['year']), int(end_date['month']), int(end_date['day']))
+    if start > end:
+        raise ValueError('start_date is after end_date')
+    return split_into_windows(start, end, shard_by)
+
+
+class GunzipWriter:
+    """File-like object decompressing gzip data written to it into another file."""
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.compressed_bytes = 0
+
+    def write(self, chunk):
+        self.compressed_bytes += len(chunk)
+        self.outfile.write(self.decompressor.decompress(chunk))
+
+    def flush(self):
+        self.outfile.write(self.decompressor.flush())
+
+
+def download_report(report_downloader, report_job_id, export_format='CSV_DUMP'):
+    """Downloads a gzipped report, decompressing it while it is downloaded.
+
+    Returns a SpooledTemporaryFile with the CSV data, which has to be closed by the caller. Its spill file,
+    if any, is removed when it is closed."""
+    report_file = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MAX_BYTES, suffix='.csv')
+    try:
+        writer = GunzipWriter(report_file)
+        report_downloader.DownloadReportToFile(report_job_id, export_format, writer, use_gzip_compression=True)
+        writer.flush()
+    except BaseException:
+        report_file.close()
+        raise
+    print('Report job with id {} downloaded ({:.1f} MB compressed, {:.1f} MB of CSV)'.format(
+        report_job_id, writer.compressed_bytes / 1024 ** 2, report_file.tell() / 1024 ** 2))
+    report_file.seek(0)
+    return report_file
+
+
+def get_report_column_types(report_file):
+    """Returns pyarrow types of report columns for the streaming reader, which fixes types after the first block.
+
+    All columns other than metrics (Column.*), i.e. dimensions, dimension attributes and custom fields, are read
+    as strings, so that e.g. PO numbers after numeric looking ones do not fail. Metrics are read as floats, which
+    every metric value can be converted to."""
+    header = next(csv.reader([report_file.readline().decode('utf-8-sig')]), [])
+    report_file.seek(0)
+    return {name: pa.float64() if name.startswith('Column.') else pa.string() for name in header}
+
+
+def read_report_table(report_file):
+    """Parses the whole report in many threads and returns it as a pyarrow Table.
+
+    Column types are inferred from the whole report, promoted across blocks (e.g. to strings)."""
+    return pa_csv.read_csv(report_file, read_options=pa_csv.ReadOptions(block_size=REPORT_BLOCK_SIZE))
+
+
+def read_report(report_file):
+    """Parses the whole report in many threads and returns it as a DataFrame."""
+    return read_report_table(report_file).to_pandas()
+
+
+def concat_report_tables(tables):
+    """Concatenates reports of date shards into one table with the same column types for all shards.
+
+    Null, integer and float columns are unified by pyarrow. Columns which are strings in one shard and numbers
+    in another are cast to strings in every shard."""
+    schemas = [table.schema for table in tables]
+    conflicting = {name for name in schemas[0].names
+                   if any(pa.types.is_string(schema.field(name).type) for schema in schemas) and
+                   any(not pa.types.is_string(schema.field(name).type) and not pa.types.is_null(schema.field(name).type)
+                       for schema in schemas)}
+    if conflicting:
+        tables = [table.cast(pa.schema([pa.field(field.name, pa.string()) if field.name in conflicting else field
+                                        for field in table.schema]))
+                  for table in tables]
+    return pa.concat_tables(tables, promote_options='permissive')
+
+
+def iter_report_chunks(report_file, chunksize):
+    """Yields DataFrames with chunksize rows of the report (fewer in the last one) and closes the report file.
+
+    Column types are given by get_report_column_types, so that all blocks and chunks have the same types."""
+    try:
+        column_types = get_report_column_types(report_file)
+        reader = pa_csv.open_csv(report_file,
+                                 read_options=pa_csv.ReadOptions(block_size=REPORT_BLOCK_SIZE),
+                                 convert_options=pa_csv.ConvertOptions(column_types=column_types))
+        batches = []
+        buffered_rows = 0
+        for batch in reader:
+            batches.append(batch)
+            buffered_rows += batch.num_rows
+            while buffered_rows >= chunksize:
+                table = pa.Table.from_batches(batches)
+                yield table.slice(0, chunksize).to_pandas()
+                batches = table.slice(chunksize).to_batches()
+                buffered_rows -= chunksize
+        if buffered_rows:
+            yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+    finally:
+        report_file.close()
@@ -1,13 +1,46 @@
+import os
+import threading
+
 import pandas as pd
 from google.api_core.exceptions import BadRequest, Forbidden, NotFound
 from google.cloud import bigquery
 
 import sroka.config.config as config
-
-KEY_FILE = config.get_file_path('google_bigquery')
-
-
-def query_bigquery(input_query, filename=None):
+from sroka.api.google_bigquery.bigquery_export import export_results
+from sroka.api.google_bigquery.bigquery_storage import (DEFAULT_MAX_STREAMS,
+                                                        contains_order_by,
+                                                        to_dataframe)
+from sroka.cache.result_cache import cached_query
+
+# Clients are created once per key file and project and reused; service account
+# credentials are refreshed by the client when they expire.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(project=None):
+    """Returns BigQuery client for the configured key file, created once per key file and project."""
+    key_file = config.get_file_path('google_bigquery')
+    client_key = (key_file, os.stat(key_file).st_mtime_ns, project)
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            # a modified key file replaces clients created with its old version
+            for old_key in [old_key for old_key in _clients if old_key[0] == key_file and old_key[2] == project]:
+                del _clients[old_key]
+            client = bigquery.Client.from_service_account_json(key_file, project=project)
+            _clients[client_key] = client
+        return client
+
+
+def clear_client_cache():
+    """Forgets all created clients."""
+    with _clients_lock:
+        _clients.clear()
+
+
+def query_bigquery(input_query, filename=None, use_storage_api=False, max_streams=DEFAULT_MAX_STREAMS,
+                   streaming=False, cache=False, refresh_cache=False, storage_source=None):
 
     if filename:
         if not isinstance(filename, str):
@@ -30,13 +63,24 @@ def query_bigquery(input_query, filename=None):
             print('input_query needs to be a string')
             return pd.DataFrame([])
 
-    client = bigquery.Client.from_service_account_json(
-        KEY_FILE)
+    client = get_client()
+
+    if cache and not filename:
+        return cached_query('bigquery', (config.get_file_path('google_bigquery'), client.project), input_query,
+                            lambda: query_bigquery(input_query, use_storage_api=use_storage_api,
+                                                   max_streams=max_streams, storage_source=storage_source),
+                            refresh=refresh_cache)
 
     query_job = client.query(input_query)
 
     try:
-        df = query_job.result().to_dataframe()
+        if filename and streaming:
+            export_results(client, query_job.result(), query_job.destination, filename, use_storage_api,
+                           max_streams, preserve_order=contains_order_by(input_query), source=storage_source)
+            print('saved to ' + filename)
+            return None
+        df = to_dataframe(client, query_job.result(), query_job.destination, use_storage_api, max_streams,
+                          preserve_order=contains_order_by(input_query), source=storage_source)
 
     except (NotFound, BadRequest) as error:
         print(error)
@@ -52,7 +96,8 @@ def query_bigquery(input_query, filename=None):
         return df
 
 
-def done_bigquery(job_id, filename=None):
+def done_bigquery(job_id, filename=None, use_storage_api=False, max_streams=DEFAULT_MAX_STREAMS,
+                  streaming=False, storage_source=None):
 
     if filename:
         if not isinstance(filename, str):
@@ -75,8 +120,7 @@ def done_bigquery(job_id, filename=None):
             print('input_query needs to be a string')
             return pd.DataFrame([])
 
-    client = bigquery.Client.from_service_account_json(
-        KEY_FILE)
+    client = get_client()
     try:
         query_job = client.get_job(job_id=job_id)
     except (BadRequest, NotFound) as error:
@@ -85,7 +129,13 @@ def done_bigquery(job_id, filename=None):
             return None
         return pd.DataFrame([])
     try:
-        df = query_job.result().to_dataframe()
+        if filename and streaming:
+            export_results(client, query_job.result(), query_job.destination, filename, use_storage_api,
+                           max_streams, preserve_order=contains_order_by(query_job.query), source=storage_source)
+            print('saved to ' + filename)
+            return None
+        df = to_dataframe(client, query_job.result(), query_job.destination, use_storage_api, max_streams,
+                          preserve_order=contains_order_by(query_job.query), source=storage_source)
     except (Forbidden, NotFound) as error:
         print(error)
         if filename:
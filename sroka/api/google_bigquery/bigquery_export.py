@@ -0,0 +1,95 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import GoogleAPICallError
+
+from sroka.api.google_bigquery.bigquery_storage import (
+    DEFAULT_MAX_STREAMS, get_storage_read_source, open_batches)
+
+EXPORT_FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+}
+# progress is printed every time at least this many rows more are written
+PROGRESS_INTERVAL_ROWS = 10 ** 6
+
+
+def get_export_format(filename):
+    """Returns 'csv', 'parquet' or 'arrow' (IPC file) based on file extension, CSV by default."""
+    return EXPORT_FORMATS.get(os.path.splitext(filename)[1].lower(), 'csv')
+
+
+def _open_writer(file, file_format, schema):
+    if file_format == 'parquet':
+        return pq.ParquetWriter(file, schema)
+    return pa.ipc.new_file(file, schema)
+
+
+def write_batches(batches, filename, schema=None, get_empty_schema=None, progress_interval=PROGRESS_INTERVAL_ROWS):
+    """Writes Arrow record batches to a file one by one, printing number of rows and bytes written every
+    progress_interval rows and at the end.
+
+    Returns number of rows written. get_empty_schema is called for the schema if there were no batches
+    and schema is not known.
+    """
+    file_format = get_export_format(filename)
+    rows_written = 0
+    rows_reported = 0
+    header_written = False
+    writer = None
+    with open(filename, 'wb') as file:
+        try:
+            for batch in batches:
+                if file_format == 'csv':
+                    df = batch.to_pandas()
+                    # index continues between batches, as if the whole DataFrame was saved at once
+                    df.index = pd.RangeIndex(rows_written, rows_written + batch.num_rows)
+                    df.to_csv(file, header=not header_written)
+                    header_written = True
+                else:
+                    if writer is None:
+                        writer = _open_writer(file, file_format, schema or batch.schema)
+                    writer.write_table(pa.Table.from_batches([batch]))
+                rows_written += batch.num_rows
+                if rows_written - rows_reported >= progress_interval:
+                    print('written {} rows, {} bytes to {}'.format(rows_written, file.tell(), filename))
+                    rows_reported = rows_written
+
+            if not header_written and writer is None:
+                schema = schema or get_empty_schema()
+                if file_format == 'csv':
+                    pd.DataFrame(columns=schema.names).to_csv(file)
+                else:
+                    writer = _open_writer(file, file_format, schema)
+        finally:
+            if writer is not None:
+                writer.close()
+    print('written {} rows, {} bytes to {}'.format(rows_written, os.path.getsize(filename), filename))
+    return rows_written
+
+
+def export_results(client, row_iterator, table, filename, use_storage_api=False, max_streams=DEFAULT_MAX_STREAMS,
+                   preserve_order=False, source=None):
+    """Streams query results to a CSV, Parquet or Arrow IPC file without building a DataFrame.
+
+    source replaces the Storage Read API client, e.g. with FakeStreamSource, and implies use_storage_api."""
+    if use_storage_api or source is not None:
+        if source is None:
+            source = get_storage_read_source(client)
+        if source is not None:
+            try:
+                schema, batches = open_batches(source, table, max_streams, preserve_order=preserve_order)
+            except GoogleAPICallError as error:
+                print('Storage Read API failed, falling back to the REST API. Error message:')
+                print(error)
+            else:
+                return write_batches(batches, filename, schema)
+
+    # the REST API returns results page by page
+    return write_batches(row_iterator.to_arrow_iterable(), filename,
+                         get_empty_schema=lambda: row_iterator.to_arrow().schema)
@@ -0,0 +1,168 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+
+import pyarrow as pa
+from google.api_core.exceptions import GoogleAPICallError
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+DEFAULT_MAX_STREAMS = 8
+
+_STREAM_END = object()
+# the same check as google-cloud-bigquery uses to read ordered results with a single stream
+_ORDER_BY = re.compile(r'ORDER\s+BY', re.IGNORECASE)
+
+
+class StorageReadSource:
+    """Reads BigQuery tables as Arrow record batches with the BigQuery Storage Read API."""
+
+    def __init__(self, credentials, project):
+        self.read_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+        self.project = project
+
+    def open(self, table, max_streams):
+        """Creates a read session and returns its Arrow schema and streams."""
+        requested_session = bigquery_storage.types.ReadSession(
+            table='projects/{}/datasets/{}/tables/{}'.format(table.project, table.dataset_id, table.table_id),
+            data_format=bigquery_storage.types.DataFormat.ARROW
+        )
+        session = self.read_client.create_read_session(
+            parent='projects/{}'.format(self.project),
+            read_session=requested_session,
+            max_stream_count=max_streams
+        )
+        schema = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+        return schema, [(session, stream.name) for stream in session.streams]
+
+    def read(self, stream):
+        """Yields Arrow record batches of a single stream."""
+        session, stream_name = stream
+        for page in self.read_client.read_rows(stream_name).rows(session).pages:
+            yield page.to_arrow()
+
+
+class FakeStreamSource:
+    """Serves an Arrow table split into streams, to use the Storage Read API path without BigQuery."""
+
+    def __init__(self, table, batch_size=1000):
+        self.table = table
+        self.batch_size = batch_size
+
+    def open(self, table, max_streams):
+        batches = self.table.to_batches(max_chunksize=self.batch_size)
+        streams_count = min(max_streams, len(batches))
+        # every stream gets a contiguous part of the table, like BigQuery streams
+        streams = [batches[len(batches) * i // streams_count:len(batches) * (i + 1) // streams_count]
+                   for i in range(streams_count)]
+        return self.table.schema, streams
+
+    def read(self, stream):
+        yield from stream
+
+
+def get_storage_read_source(client):
+    """Returns StorageReadSource using BigQuery client credentials, or None if the Storage API is not available."""
+    if bigquery_storage is None:
+        print('google-cloud-bigquery-storage is not installed, falling back to the REST API')
+        return None
+    return StorageReadSource(client._credentials, client.project)
+
+
+def contains_order_by(query):
+    """Tells if the query orders its results. The Storage Read API keeps the order of rows only in a single stream."""
+    return bool(query) and _ORDER_BY.search(query) is not None
+
+
+def read_table(source, table, max_streams=DEFAULT_MAX_STREAMS, preserve_order=False):
+    """Reads all streams of a table concurrently and returns them as one Arrow table.
+
+    With preserve_order a single stream is read, so that rows of ordered results keep their order."""
+    schema, streams = source.open(table, 1 if preserve_order else max_streams)
+    if not streams:
+        return schema.empty_table()
+
+    def read_stream(stream):
+        return pa.Table.from_batches(list(source.read(stream)), schema=schema)
+
+    with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        tables = list(executor.map(read_stream, streams))
+    return pa.concat_tables(tables)
+
+
+def open_batches(source, table, max_streams=DEFAULT_MAX_STREAMS, max_queued_batches=None, preserve_order=False):
+    """Opens a read session and returns its Arrow schema and an iterator of record batches of all streams.
+
+    Streams are read concurrently and batches are yielded as they arrive, in no particular order. With
+    preserve_order a single stream is read, so batches keep the order of rows. At most max_queued_batches
+    (default: two per stream) batches are held in memory.
+    """
+    schema, streams = source.open(table, 1 if preserve_order else max_streams)
+    return schema, _iter_batches(source, streams, max_queued_batches or 2 * max(len(streams), 1))
+
+
+def _iter_batches(source, streams, max_queued_batches):
+    if not streams:
+        return
+    queue = Queue(maxsize=max_queued_batches)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def read_stream(stream):
+        try:
+            for batch in source.read(stream):
+                if not put(batch):
+                    return
+        except Exception as error:
+            put(error)
+        finally:
+            put(_STREAM_END)
+
+    with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        for stream in streams:
+            executor.submit(read_stream, stream)
+        try:
+            finished_streams = 0
+            while finished_streams < len(streams):
+                try:
+                    item = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                if item is _STREAM_END:
+                    finished_streams += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # stops readers if the batches were not consumed till the end
+            stop.set()
+
+
+def to_dataframe(client, row_iterator, table, use_storage_api=False, max_streams=DEFAULT_MAX_STREAMS,
+                 preserve_order=False, source=None):
+    """Downloads query results, through the Storage Read API if requested and available.
+
+    source replaces the Storage Read API client, e.g. with FakeStreamSource, and implies use_storage_api."""
+    if use_storage_api or source is not None:
+        if source is None:
+            source = get_storage_read_source(client)
+        if source is not None:
+            try:
+                return read_table(source, table, max_streams, preserve_order).to_pandas()
+            except GoogleAPICallError as error:
+                print('Storage Read API failed, falling back to the REST API. Error message:')
+                print(error)
+    return row_iterator.to_dataframe()
@@ -1,15 +1,21 @@
 import os
-from configparser import NoSectionError
+from functools import partial
 from pathlib import Path
 
 import mysql.connector
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from mysql.connector.errors import (DatabaseError, InternalError,
-                                    OperationalError)
+                                    OperationalError, PoolError)
 from retrying import retry
 
-from sroka.api.mysql.mysql_helpers import (get_options_from_config,
-                                           validate_options)
+from sroka.api.mysql.mysql_columnar import (column_arrow_type, fetch_frame,
+                                            rows_to_table, table_to_frame)
+from sroka.api.mysql.mysql_helpers import resolve_options
+from sroka.api.mysql.mysql_pool import (DEFAULT_POOL_SIZE, acquire_connection,
+                                        release_connection)
+from sroka.cache.result_cache import cached_query
 
 
 @retry(stop_max_attempt_number=1,
@@ -18,65 +24,114 @@ from sroka.api.mysql.mysql_helpers import (get_options_from_config,
 def query_mysql(query: str, filename=None,
                 host=None, port=None,
                 unix_socket=None, user=None,
-                password=None, database=None
+                password=None, database=None,
+                chunksize=None, pooled=False,
+                pool_size=DEFAULT_POOL_SIZE, connection=None,
+                columnar=False, cache=False, refresh_cache=False
                 ):
-    try:
-        options = get_options_from_config()
-
-    except NoSectionError:
-        print('Missing MySQL section in configuration')
-        return pd.DataFrame([])
-
-    if host:
-        options['host'] = host
-    if port:
-        options['port'] = port
-    if unix_socket:
-        options['unix_socket'] = unix_socket
-    if user:
-        options['user'] = user
-    if password:
-        options['password'] = password
-    if database:
-        options['database'] = database
-
-    if not validate_options(options):
+    if chunksize is not None and (not isinstance(chunksize, int) or chunksize < 1):
+        print('chunksize must be a positive integer')
         return pd.DataFrame([])
 
+    if connection is None:
+        options = resolve_options(host, port, unix_socket, user, password, database)
+        if options is None:
+            return pd.DataFrame([])
+
+        if cache and not filename and not chunksize:
+            identity = [options.get(key) for key in ('host', 'port', 'unix_socket', 'user', 'database')]
+            return cached_query('mysql', identity, query,
+                                lambda: query_mysql(query, pooled=pooled, pool_size=pool_size, columnar=columnar,
+                                                    **options),
+                                refresh=refresh_cache)
+
+    # Either closes the connection or returns it to the pool. A connection
+    # passed by the caller is left open.
+    release = _keep_connection
     try:
-        # Connect while passing only the arguments that were set in the
-        # configuration, since some are mutually exclusive or optional.
-        connection = mysql.connector.connect(**{k: v for k, v in options.items() if v != ""})
+        if connection is None and pooled:
+            connection = acquire_connection(options, pool_size)
+            release = partial(release_connection, connection)
+        elif connection is None:
+            connection = mysql.connector.connect(**options)
+            release = connection.close
 
         # Get the MySQL connector cursor, which allows interacting with the
-        # MySQL server.
-        cursor = connection.cursor()
+        # MySQL server. In chunked mode rows are streamed from the server
+        # instead of being buffered on the client.
+        cursor = connection.cursor(buffered=False) if chunksize else connection.cursor()
 
         # Execute the query.
         cursor.execute(query)
 
+    except PoolError as e:
+        print('MySQL Pool Error: {}'.format(e))
+        return pd.DataFrame([])
     except OperationalError as e:
         print('Operational MySQL Error: {}'.format(e))
+        release()
         return pd.DataFrame([])
     except InternalError as e:
         print('Internal MySQL Error: {}'.format(e))
+        release()
         return pd.DataFrame([])
     except DatabaseError as e:
         print('Database MySQL Error: {}'.format(e))
+        release()
         return pd.DataFrame([])
 
-    # Cycle through the returned elements to build a pandas DataFrame.
-    df = pd.DataFrame(cursor, columns=cursor.column_names)
-
-    # Close the connection to the MySQL server.
+    if chunksize:
+        chunks = _fetch_chunks(cursor, chunksize, release, columnar)
+        if not filename:
+            return chunks
+        _make_parent_directory(filename)
+        try:
+            _write_chunks(chunks, filename, cursor.column_names, cursor.description)
+        except OSError as e:
+            print('Unable to write on filesystem: {}'.format(e))
+        except pa.ArrowException as e:
+            print('Unable to convert data to Parquet: {}'.format(e))
+        finally:
+            chunks.close()
+        return None
+
+    # Cycle through the returned elements to build a pandas DataFrame, or
+    # build it column by column from typed Arrow arrays.
+    if columnar:
+        df = fetch_frame(cursor)
+    else:
+        df = pd.DataFrame(cursor, columns=cursor.column_names)
+
+    # Close the connection to the MySQL server, or return it to the pool.
     cursor.close()
-    connection.close()
+    release()
 
     # If no filename is specified, return the data as a pandas Dataframe.
     # Otherwise, store it in a file.
     if not filename:
         return df
 
+    _make_parent_directory(filename)
+
+    # Export the data in a CSV or Parquet file.
+    try:
+        if _is_parquet(filename):
+            df.to_parquet(filename)
+        else:
+            df.to_csv(filename)
+    except OSError as e:
+        print('Unable to write on filesystem: {}'.format(e))
+
+
+def _keep_connection():
+    pass
+
+
+def _is_parquet(filename):
+    return str(filename).lower().endswith(('.parquet', '.parq', '.pq'))
+
+
+def _make_parent_directory(filename):
     # Store the path in a cross-platform pathlib object to ensure compatibility
     # with DOS & UNIX-based operating systems.
     path = Path(filename)
@@ -89,8 +144,71 @@ def query_mysql(query: str, filename=None,
     if directory_path != "":
         os.makedirs(directory_path, exist_ok=True)
 
-    # Export the data in a CSV file.
+
+def _fetch_chunks(cursor, chunksize, release, columnar=False):
+    # Yields DataFrames of at most `chunksize` rows, indexed as if they were
+    # slices of a single DataFrame, so only one chunk is held in memory.
     try:
-        df.to_csv(filename)
-    except OSError as e:
-        print('Unable to write on filesystem: {}'.format(e))
+        offset = 0
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            index = pd.RangeIndex(offset, offset + len(rows))
+            if columnar:
+                yield table_to_frame(rows_to_table(rows, cursor.description), index)
+            else:
+                yield pd.DataFrame(rows, columns=cursor.column_names, index=index)
+            offset += len(rows)
+        cursor.close()
+    finally:
+        # Closing the connection also discards rows which were not read,
+        # e.g. when the caller stopped iterating early.
+        release()
+
+
+def _write_chunks(chunks, filename, column_names, description):
+    # Writes the chunks one by one, appending to the CSV file or adding row
+    # groups to the Parquet file. A partially written file is removed if
+    # writing fails.
+    parquet_writer = None
+    chunks_written = 0
+    try:
+        for chunk in chunks:
+            if _is_parquet(filename):
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(filename, _parquet_schema(table.schema, description))
+                parquet_writer.write_table(table.cast(parquet_writer.schema))
+            else:
+                chunk.to_csv(filename, mode='w' if chunks_written == 0 else 'a', header=chunks_written == 0)
+            chunks_written += 1
+    except BaseException:
+        if parquet_writer is not None:
+            parquet_writer.close()
+            parquet_writer = None
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    if chunks_written == 0:
+        empty_df = pd.DataFrame(columns=column_names)
+        if _is_parquet(filename):
+            empty_df.to_parquet(filename)
+        else:
+            empty_df.to_csv(filename)
+
+
+def _parquet_schema(schema, description):
+    # Columns with only NULLs in the first chunk get the type of the MySQL
+    # field (strings if it is not known), so that values in later chunks can
+    # be cast to it.
+    fields = []
+    for field, column in zip(schema, description):
+        if pa.types.is_null(field.type):
+            field = field.with_type(column_arrow_type(column) or pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
@@ -0,0 +1,98 @@
+import pandas as pd
+import pyarrow as pa
+from mysql.connector.constants import FieldFlag, FieldType
+
+DEFAULT_BATCH_SIZE = 100000
+
+_INTEGER_TYPES = {FieldType.TINY, FieldType.SHORT, FieldType.INT24, FieldType.LONG, FieldType.LONGLONG,
+                  FieldType.YEAR}
+_FLOAT_TYPES = {FieldType.FLOAT, FieldType.DOUBLE}
+_DECIMAL_TYPES = {FieldType.DECIMAL, FieldType.NEWDECIMAL}
+_DATETIME_TYPES = {FieldType.DATETIME, FieldType.TIMESTAMP}
+_DATE_TYPES = {FieldType.DATE, FieldType.NEWDATE}
+
+
+def _arrow_type(type_code, flags=0):
+    # Returns the Arrow type of a column based on the MySQL field type and
+    # flags, or None if it should be inferred from the values.
+    if type_code == FieldType.LONGLONG and flags & FieldFlag.UNSIGNED:
+        # BIGINT UNSIGNED values may not fit in int64.
+        return pa.uint64()
+    if type_code in _INTEGER_TYPES:
+        return pa.int64()
+    if type_code in _FLOAT_TYPES:
+        return pa.float64()
+    if type_code in _DATETIME_TYPES:
+        return pa.timestamp('us')
+    if type_code in _DATE_TYPES:
+        return pa.date32()
+    if type_code == FieldType.TIME:
+        return pa.duration('us')
+    return None
+
+
+def _column_flags(column):
+    # Flags are the 8th item of a column description, which fake cursors may lack.
+    return column[7] if len(column) > 7 and column[7] else 0
+
+
+def column_arrow_type(column):
+    """Returns the Arrow type of a column of a cursor description, or None if it is inferred from the values."""
+    if column[1] in _DECIMAL_TYPES:
+        return pa.float64()
+    return _arrow_type(column[1], _column_flags(column))
+
+
+def _column_to_array(values, type_code, flags=0):
+    arrow_type = _arrow_type(type_code, flags)
+    try:
+        if type_code in _DECIMAL_TYPES:
+            # Decimals are converted to floats to avoid a column of Python objects.
+            # Converting them in Python is much faster than inferring a decimal
+            # type in pyarrow and casting it.
+            return pa.array([None if value is None else float(value) for value in values], type=pa.float64())
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        return pa.array(values, from_pandas=True)
+
+
+def rows_to_table(rows, description):
+    """Builds an Arrow table from a list of row tuples, one typed column at a time."""
+    names = [column[0] for column in description]
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    arrays = [_column_to_array(list(values), column[1], _column_flags(column))
+              for values, column in zip(columns, description)]
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def table_to_frame(table, index=None):
+    """Converts an Arrow table to a DataFrame without object columns for numbers and dates."""
+    df = table.to_pandas(date_as_object=False)
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_integer(column.type) and column.null_count:
+            # Integers with NULLs would otherwise become floats, losing precision of big ids.
+            column = column.combine_chunks()
+            df[name] = pd.arrays.IntegerArray(column.fill_null(0).to_numpy(),
+                                              column.is_null().to_numpy(zero_copy_only=False))
+    if index is not None:
+        df.index = index
+    return df
+
+
+def fetch_table(cursor, batch_size=DEFAULT_BATCH_SIZE):
+    """Fetches all rows from an executed cursor into an Arrow table, batch_size rows at a time."""
+    tables = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        tables.append(rows_to_table(rows, cursor.description))
+    if not tables:
+        return rows_to_table([], cursor.description)
+    # Columns with only NULLs in some batches are promoted to the type found in other batches.
+    return pa.concat_tables(tables, promote_options='default')
+
+
+def fetch_frame(cursor, batch_size=DEFAULT_BATCH_SIZE):
+    """Fetches all rows from an executed cursor into a typed DataFrame."""
+    return table_to_frame(fetch_table(cursor, batch_size))
@@ -1,4 +1,4 @@
-from configparser import NoOptionError
+from configparser import NoOptionError, NoSectionError
 
 import sroka.config.config as config
 
@@ -60,3 +60,35 @@ def validate_options(options: dict):
               'the host/port options or the unix_socket option must be set.')
         return False
     return True
+
+
+# Gets the options from the configuration file, overridden by the non-empty
+# arguments. Returns None if the options are missing or invalid.
+def resolve_options(host=None, port=None, unix_socket=None, user=None,
+                    password=None, database=None):
+    try:
+        options = get_options_from_config()
+
+    except NoSectionError:
+        print('Missing MySQL section in configuration')
+        return None
+
+    if host:
+        options['host'] = host
+    if port:
+        options['port'] = port
+    if unix_socket:
+        options['unix_socket'] = unix_socket
+    if user:
+        options['user'] = user
+    if password:
+        options['password'] = password
+    if database:
+        options['database'] = database
+
+    if not validate_options(options):
+        return None
+
+    # Pass only the arguments that were set in the configuration, since some
+    # are mutually exclusive or optional.
+    return {k: v for k, v in options.items() if v != ""}
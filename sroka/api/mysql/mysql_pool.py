@@ -0,0 +1,116 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+from mysql.connector.errors import Error, PoolError
+
+from sroka.api.mysql.mysql_helpers import resolve_options
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_IDLE = 5 * 60
+DEFAULT_POOL_TIMEOUT = 30
+
+# Pools are shared by all the calls using the same connection options.
+_pools = {}
+_last_used = {}
+_lock = threading.Lock()
+
+
+def get_pool(options, pool_size=DEFAULT_POOL_SIZE):
+    """Returns connection pool for given connection options, creating it on first use.
+
+    Raises PoolError if the pool already exists with a different size."""
+    pool_key = tuple(sorted(options.items()))
+    with _lock:
+        pool = _pools.get(pool_key)
+        if pool is None:
+            pool = pooling.MySQLConnectionPool(pool_name='sroka_{}'.format(len(_pools)),
+                                               pool_size=pool_size, **options)
+            _pools[pool_key] = pool
+        elif pool.pool_size != pool_size:
+            raise PoolError('A pool of size {} already exists for these connection options, close_pools() '
+                            'before using a different pool_size'.format(pool.pool_size))
+        return pool
+
+
+def acquire_connection(options, pool_size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                       pool_timeout=DEFAULT_POOL_TIMEOUT):
+    """Gets a healthy connection from the pool, waiting up to pool_timeout seconds for a free one."""
+    pool = get_pool(options, pool_size)
+    deadline = time.monotonic() + pool_timeout
+    while True:
+        try:
+            connection = pool.get_connection()
+            break
+        except PoolError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+    # PooledMySQLConnection wraps the same underlying connection every time it
+    # is taken from the pool, so it identifies the connection.
+    last_used = _last_used.get(id(connection._cnx))
+    try:
+        if max_idle is not None and last_used is not None and time.monotonic() - last_used > max_idle:
+            # Connections idle for too long are likely to be dropped by the server.
+            connection.reconnect()
+        elif not connection.is_connected():
+            connection.reconnect()
+    except Error:
+        release_connection(connection)
+        raise
+    return connection
+
+
+def release_connection(connection):
+    """Returns connection to the pool."""
+    _last_used[id(connection._cnx)] = time.monotonic()
+    try:
+        connection.close()
+    except Error:
+        # The connection is returned to the pool anyway and checked before next use.
+        pass
+
+
+def _close_idle_connections(pool):
+    # Every idle connection is taken from the pool and disconnected, at most
+    # pool_size of them, as connections which fail to reconnect are returned
+    # to the pool. Connections in use are left to their users.
+    for _ in range(pool.pool_size):
+        try:
+            connection = pool.get_connection()
+        except PoolError:
+            return
+        except Error:
+            continue
+        try:
+            connection.disconnect()
+        except Error:
+            pass
+
+
+def close_pools():
+    """Closes all idle pooled connections and forgets the pools."""
+    with _lock:
+        for pool in _pools.values():
+            _close_idle_connections(pool)
+        _pools.clear()
+        _last_used.clear()
+
+
+@contextmanager
+def mysql_connection(host=None, port=None,
+                     unix_socket=None, user=None,
+                     password=None, database=None,
+                     pool_size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_MAX_IDLE,
+                     pool_timeout=DEFAULT_POOL_TIMEOUT):
+    """Yields a pooled connection which can be passed to query_mysql to run several queries on it."""
+    options = resolve_options(host, port, unix_socket, user, password, database)
+    if options is None:
+        raise ValueError('Invalid MySQL configuration')
+    connection = acquire_connection(options, pool_size, max_idle, pool_timeout)
+    try:
+        yield connection
+    finally:
+        release_connection(connection)
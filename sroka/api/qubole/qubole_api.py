@@ -9,6 +9,7 @@ from qds_sdk.exception import (ForbiddenAccess, ResourceInvalid,
 from qds_sdk.qubole import Qubole
 
 import sroka.config.config as config
+from sroka.cache.result_cache import cached_query
 
 
 @contextmanager
@@ -30,13 +31,15 @@ def execute_with_handling_errors(func, *args, **kwargs):
         yield result
 
 
-def request_qubole(input_query, query_type='presto', cluster_label=None):
+def request_qubole(input_query, query_type='presto', cluster_label=None, cache=False, refresh_cache=False):
     """Sends SQL query to Qubole and retrieves
     the data as pandas DataFrame.
 
     :param str input_query: query in chosen language (SQL)
     :param str query_type: query language specification {'presto' (default) or 'hive'}
     :param str cluster_label: Name of the Qubole cluster
+    :param bool cache: return result cached on disk, if available
+    :param bool refresh_cache: run the query and replace the cached result
     :return:  pandas DataFrame with response data.
     :rtype: pandas.DataFrame
     """
@@ -44,6 +47,10 @@ def request_qubole(input_query, query_type='presto', cluster_label=None):
         if api_token is None:
             return pd.DataFrame([])
 
+    if cache:
+        return cached_query('qubole', (api_token, query_type, cluster_label), input_query,
+                            lambda: request_qubole(input_query, query_type, cluster_label), refresh=refresh_cache)
+
     Qubole.configure(api_token=api_token)
 
     # run query
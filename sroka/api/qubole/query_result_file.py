@@ -1,13 +1,13 @@
 import re
 import tempfile
 
-import boto3
 from qds_sdk.account import Account
 from qds_sdk.commands import Command, HiveCommand, PrestoCommand
 from qds_sdk.exception import UnauthorizedAccess
 from qds_sdk.qubole import Qubole
 
 import sroka.config.config as config
+from sroka.api.aws.aws_session import get_resource
 from sroka.api.qubole.qubole_api import execute_with_handling_errors
 
 
@@ -34,12 +34,8 @@ def _get_results(command, output, delimiter=None):
     conn = Qubole.agent()
     storage_credentials = conn.get(Account.credentials_rest_entity_path)
 
-    session = boto3.Session(
-            aws_access_key_id=storage_credentials['storage_access_key'],
-            aws_secret_access_key=storage_credentials['storage_secret_key']
-        )
-
-    s3 = session.resource('s3')
+    s3 = get_resource('s3', storage_credentials['storage_access_key'],
+                      storage_credentials['storage_secret_key'])
 
     result_path = command.meta_data['results_resource']
     results = conn.get(result_path, {'inline': False, 'include_headers': 'false'})
@@ -1,68 +1,195 @@
 import re
+import threading
+import time
 import warnings
-from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import StringIO
 
-import boto3
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from botocore.exceptions import ClientError, ParamValidationError
 from pandas.errors import EmptyDataError
 
 import sroka.config.config as config
+from sroka.api.aws.aws_session import get_arrow_filesystem, get_resource
 
 warnings.filterwarnings('ignore')
 
+PARQUET_MAGIC = b'PAR1'
+PARQUET_EXTENSIONS = ('.parquet', '.parq', '.pq')
+CSV_EXTENSIONS = ('.csv', '.tsv', '.txt')
+
+
+class _ByteBudget:
+    """Limits number of bytes downloaded but not yet parsed by concurrent workers."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            # a single object bigger than the limit is still downloaded, alone
+            while self.in_flight > 0 and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+def _detect_format(client, bucket_name, key, size=None):
+    lower_key = key.lower()
+    if lower_key.endswith(PARQUET_EXTENSIONS):
+        return 'parquet'
+    if lower_key.endswith(CSV_EXTENSIONS) or size == 0:
+        return 'csv'
+    # only the first bytes are fetched to check for the Parquet magic number
+    try:
+        head = client.get_object(Bucket=bucket_name, Key=key, Range='bytes=0-3')['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRange':
+            return 'csv'
+        raise
+    return 'parquet' if head == PARQUET_MAGIC else 'csv'
+
+
+def _read_parquet_dataset(filesystem, bucket_name, keys, base_dir, columns=None, filters=None):
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+    dataset = ds.dataset(['{}/{}'.format(bucket_name, key) for key in keys], filesystem=filesystem,
+                         format='parquet', partitioning='hive',
+                         partition_base_dir='{}/{}'.format(bucket_name, base_dir).rstrip('/'))
+    # columns and filters are pushed down, so only needed columns and row groups are read
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+
+def _read_csv(body, sep, header_setting, columns=None):
+    return pd.read_csv(StringIO(str(body, 'utf-8')), on_bad_lines='skip', sep=sep,
+                       header=header_setting, usecols=columns)
+
+
+def _read_object(client, bucket_name, key, sep, header_setting, columns=None):
+    start = time.perf_counter()
+    body = client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    download_time = time.perf_counter() - start
+    try:
+        data = _read_csv(body, sep, header_setting, columns)
+    except EmptyDataError:
+        data = None
+    return data, len(body), download_time, time.perf_counter() - start - download_time
+
+
+def _download_prefix_concurrently(s3, bucket_name, objects, sep, header_setting, skip_empty_files,
+                                  max_workers, max_in_flight_bytes=None, print_timings=False, columns=None):
+    # s3 resources are not thread-safe, the underlying client is
+    client = s3.meta.client
+    budget = _ByteBudget(max_in_flight_bytes) if max_in_flight_bytes else None
+
+    def task(key, size):
+        try:
+            return _read_object(client, bucket_name, key, sep, header_setting, columns)
+        finally:
+            if budget:
+                budget.release(size)
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, size in objects:
+            if budget:
+                budget.acquire(size)
+            futures.append((key, executor.submit(task, key, size)))
+
+    # results are gathered in listing order, regardless of which download finished first
+    df_list = []
+    for key, future in futures:
+        data, size, download_time, parse_time = future.result()
+        if print_timings:
+            print('{}: {} bytes, downloaded in {:.3f}s, parsed in {:.3f}s'.format(
+                key, size, download_time, parse_time))
+        if data is None:
+            if skip_empty_files is False:
+                print('Encountered an empty file: ', key)
+                return None
+        else:
+            df_list.append(data)
+    return df_list
+
 
 def _download_data(key_prefix, s3, bucket_name, prefix, sep, skip_empty_files=True,
-                   first_row_columns=True):
+                   first_row_columns=True, max_workers=None, max_in_flight_bytes=None, print_timings=False,
+                   file_format=None, columns=None, filters=None, get_filesystem=None):
     if first_row_columns:
         header_setting = 'infer'
     else:
         header_setting = None
     df_list = []
-    if prefix is False:
-        file = s3.Object(bucket_name, key_prefix)
-        try:
-            data = StringIO(str(file.get()['Body'].read(), 'utf-8'))
-        except UnicodeDecodeError:
-            data = BytesIO(file.get()['Body'].read())
-        except ClientError:
-            print('File not found on s3')
+    try:
+        if prefix is False:
+            objects = [(key_prefix, None)]
+            base_dir = key_prefix.rpartition('/')[0]
+        else:
+            objects = [(file.key, file.size) for file in s3.Bucket(bucket_name).objects.filter(Prefix=key_prefix)
+                       if 'SUCCESS' not in file.key]
+            base_dir = key_prefix if key_prefix.endswith('/') else key_prefix.rpartition('/')[0]
+        non_empty_objects = [(key, size) for key, size in objects if size != 0]
+        if not file_format and non_empty_objects:
+            file_format = _detect_format(s3.meta.client, bucket_name, *non_empty_objects[0])
+    except ClientError:
+        print('File not found on s3')
+        return pd.DataFrame([])
+
+    if file_format == 'parquet':
+        if not non_empty_objects:
+            print('No matching file found')
             return pd.DataFrame([])
         try:
-            df_list.append(pd.read_csv(data, on_bad_lines='skip', sep=sep,
-                                       header=header_setting))
-        except UnicodeDecodeError:
-            df_list.append(pq.read_pandas(data).to_pandas())
-        except EmptyDataError:
-            print('File is empty')
+            # skips metadata files written by Hive/Spark, e.g. _common_metadata
+            keys = [key for key, _ in non_empty_objects if not key.rpartition('/')[2].startswith(('_', '.'))]
+            return _read_parquet_dataset(get_filesystem(), bucket_name, keys, base_dir, columns, filters)
+        except OSError as e:
+            print('Could not read Parquet data from s3. Error message:')
+            print(e)
             return pd.DataFrame([])
 
-    else:
-        bucket = s3.Bucket(bucket_name)
+    try:
+        if prefix is False:
+            try:
+                df_list.append(_read_csv(s3.Object(bucket_name, key_prefix).get()['Body'].read(), sep,
+                                         header_setting, columns))
+            except EmptyDataError:
+                print('File is empty')
+                return pd.DataFrame([])
 
-        try:
-            for file in bucket.objects.filter(Prefix=key_prefix):
-                if 'SUCCESS' not in file.key:
-                    tmp = StringIO(str(file.get()['Body'].read(), 'utf-8'))
-                    try:
-                        data = pd.read_csv(tmp, on_bad_lines='skip', sep=sep,
-                                           header=header_setting)
-                        df_list.append(data)
-                    except EmptyDataError:
-                        if skip_empty_files is False:
-                            print('Encountered an empty file: ', file.key)
-                            return pd.DataFrame([])
-
-        except UnicodeDecodeError:
-            for file in bucket.objects.filter(Prefix=key_prefix):
-                if 'SUCCESS' not in file.key:
-                    data = BytesIO(file.get()['Body'].read())
-                    df_list.append(pq.read_pandas(data).to_pandas())
-        except ClientError:
-            print('File not found on s3')
-            return pd.DataFrame([])
+        elif max_workers and max_workers > 1:
+            df_list = _download_prefix_concurrently(s3, bucket_name, objects, sep, header_setting,
+                                                    skip_empty_files, max_workers, max_in_flight_bytes,
+                                                    print_timings, columns)
+            if df_list is None:
+                return pd.DataFrame([])
+
+        else:
+            for key, _ in objects:
+                try:
+                    df_list.append(_read_csv(s3.Object(bucket_name, key).get()['Body'].read(), sep,
+                                             header_setting, columns))
+                except EmptyDataError:
+                    if skip_empty_files is False:
+                        print('Encountered an empty file: ', key)
+                        return pd.DataFrame([])
+
+    except UnicodeDecodeError:
+        print('File is neither a UTF-8 text file nor a Parquet file')
+        return pd.DataFrame([])
+    except ClientError:
+        print('File not found on s3')
+        return pd.DataFrame([])
 
     if not df_list:
         print('No matching file found')
@@ -72,15 +199,11 @@ def _download_data(key_prefix, s3, bucket_name, prefix, sep, skip_empty_files=Tr
 
 
 def s3_download_data(s3_filename, prefix=False, output_file=None, sep=',', skip_empty_files=True,
-                     first_row_columns=True):
+                     first_row_columns=True, max_workers=None, max_in_flight_bytes=None, print_timings=False,
+                     file_format=None, columns=None, filters=None):
     key_id = config.get_value('aws', 'aws_access_key_id')
     access_key = config.get_value('aws', 'aws_secret_access_key')
-    session = boto3.Session(
-        aws_access_key_id=key_id,
-        aws_secret_access_key=access_key
-    )
-
-    s3 = session.resource('s3')
+    s3 = get_resource('s3', key_id, access_key)
 
     s3_file_pattern = re.compile(r's3://([^/]+)/?(.*)')
 
@@ -89,10 +212,17 @@ def s3_download_data(s3_filename, prefix=False, output_file=None, sep=',', skip_
 
     key_prefix = match.group(2)
 
+    if file_format not in (None, 'csv', 'parquet'):
+        print("file_format must be None, 'csv' or 'parquet'")
+        return pd.DataFrame([])
+
     if isinstance(sep, str) and len(sep) == 1:
 
+        # the Arrow filesystem is only needed, and built, for Parquet files
         data = _download_data(key_prefix, s3, bucket_name, prefix, sep, skip_empty_files,
-                              first_row_columns)
+                              first_row_columns, max_workers, max_in_flight_bytes, print_timings,
+                              file_format, columns, filters,
+                              partial(get_arrow_filesystem, key_id, access_key, bucket_name))
 
         if output_file:
             data.to_csv(output_file, sep=sep)
@@ -106,10 +236,6 @@ def s3_download_data(s3_filename, prefix=False, output_file=None, sep=',', skip_
 def s3_upload_data(data, bucket, path, sep=','):
     key_id = config.get_value('aws', 'aws_access_key_id')
     access_key = config.get_value('aws', 'aws_secret_access_key')
-    session = boto3.Session(
-        aws_access_key_id=key_id,
-        aws_secret_access_key=access_key
-    )
 
     if isinstance(sep, str) and len(sep) == 1:
 
@@ -122,7 +248,7 @@ def s3_upload_data(data, bucket, path, sep=','):
             elif isinstance(data, np.ndarray):
                 np.savetxt(csv_buffer, data, delimiter=sep, fmt='%s')
 
-            s3 = session.resource('s3')
+            s3 = get_resource('s3', key_id, access_key)
             data = csv_buffer.getvalue()
 
             try:
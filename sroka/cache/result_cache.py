@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+import sroka.config.config as config
+
+DEFAULT_CACHE_DIRECTORY = os.path.expanduser('~/.sroka_cache/')
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_SIZE_MB = 1024
+
+# String literals are matched first, so comments and whitespace inside them are kept.
+_sql_tokens = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|(?:--[^\n]*|/\*.*?\*/|\s+)+",
+                         re.DOTALL)
+
+_settings = {}
+_stats = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def setup_result_cache(directory=None, ttl=None, max_size_mb=None):
+    """Function that overrides result cache settings from [cache] section of config.ini."""
+    if directory is not None:
+        _settings['directory'] = directory
+    if ttl is not None:
+        _settings['ttl'] = ttl
+    if max_size_mb is not None:
+        _settings['max_size_mb'] = max_size_mb
+
+
+def _get_setting(key, default, cast):
+    if key in _settings:
+        return _settings[key]
+    try:
+        if config.has_value('cache', key):
+            return cast(config.get_value('cache', key))
+    except FileNotFoundError:
+        pass
+    return default
+
+
+def get_cache_directory():
+    return _get_setting('directory', DEFAULT_CACHE_DIRECTORY, os.path.expanduser)
+
+
+def get_cache_stats():
+    """Function that returns number of cache hits and misses in this process."""
+    with _lock:
+        return dict(_stats)
+
+
+def normalize_query(query):
+    """Removes comments, repeated whitespace and trailing semicolons, which do not change query results."""
+    def replace(match):
+        token = match.group(0)
+        return token if token[0] in '\'"`' else ' '
+    return _sql_tokens.sub(replace, query).strip().rstrip(';').strip()
+
+
+def get_cache_key(backend, identity, query):
+    """Hash of backend, connection identity (e.g. credentials, project, database) and normalized query."""
+    payload = json.dumps([backend, [str(value) for value in identity], normalize_query(query)])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _paths(key):
+    directory = get_cache_directory()
+    return os.path.join(directory, key + '.parquet'), os.path.join(directory, key + '.json')
+
+
+def read_cached(key, ttl=None):
+    """Returns cached DataFrame or None if it is missing or older than ttl seconds."""
+    data_path, metadata_path = _paths(key)
+    ttl = _get_setting('ttl', DEFAULT_TTL, int) if ttl is None else ttl
+    try:
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+        if time.time() - metadata['created'] > ttl:
+            return None
+        df = pd.read_parquet(data_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    # modification time of the data file is the last use, for LRU eviction
+    os.utime(data_path)
+    return df
+
+
+def write_cached(key, df, backend, query):
+    """Stores DataFrame as Parquet and evicts least recently used results over the size limit."""
+    directory = get_cache_directory()
+    os.makedirs(directory, exist_ok=True)
+    data_path, metadata_path = _paths(key)
+    temporary_path = None
+    try:
+        # written to a temporary file first, so other processes never read a partial file
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as file:
+            temporary_path = file.name
+        df.to_parquet(temporary_path)
+        os.replace(temporary_path, data_path)
+    except (ValueError, TypeError, OSError, ImportError) as e:
+        print('Result could not be cached: {}'.format(e))
+        if temporary_path and os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return
+    with open(metadata_path, 'w') as file:
+        json.dump({'backend': backend, 'query': normalize_query(query), 'created': time.time(), 'rows': len(df)},
+                  file)
+    evict(_get_setting('max_size_mb', DEFAULT_MAX_SIZE_MB, float) * 1024 ** 2)
+
+
+def evict(max_size):
+    """Removes least recently used results until the cache is smaller than max_size bytes."""
+    directory = get_cache_directory()
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.parquet'):
+            path = os.path.join(directory, name)
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        for entry_path in (path, path[:-len('.parquet')] + '.json'):
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+        total_size -= size
+
+
+def clear_result_cache():
+    """Removes all cached results."""
+    evict(0)
+
+
+def cached_query(backend, identity, query, run, refresh=False, ttl=None):
+    """Returns cached result of the query or runs it and caches the result.
+
+    Empty results are not cached, since the APIs return an empty DataFrame on errors too.
+    """
+    key = get_cache_key(backend, identity, query)
+    if not refresh:
+        df = read_cached(key, ttl)
+        if df is not None:
+            with _lock:
+                _stats['hits'] += 1
+            return df
+    with _lock:
+        _stats['misses'] += 1
+    df = run()
+    if isinstance(df, pd.DataFrame) and not df.empty:
+        write_cached(key, df, backend, query)
+    return df
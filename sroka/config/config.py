@@ -2,12 +2,27 @@ import configparser
 import json
 import os
 import stat
+import threading
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 default_config_filepath = os.path.expanduser('~/.sroka_config/')
 
+# Environment variable and default file name of the configuration files used by each API.
+_file_path_settings = {
+    'google_ad_manager': ('CONFIG_AD_MANAGER', 'ad_manager.json'),
+    'google_analytics': ('CONFIG_GOOGLE_ANALYTICS', 'client_secrets.json'),
+    'google_drive': ('CONFIG_GOOGLE_DRIVE', 'credentials.json'),
+    'google_bigquery': ('GOOGLE_APPLICATION_CREDENTIALS', 'bigquery_credentials.json'),
+}
+
+# Parsed config.ini shared by the whole process. It is re-read only when the
+# path, modification time or size of the file changes.
+_config_cache = {'key': None, 'parser': None}
+_config_stats = {'reads': 0, 'hits': 0}
+_config_lock = threading.Lock()
+
 
 def set_google_credentials(authorized_user_file,
                            key_file_location,
@@ -30,43 +45,65 @@ def set_google_credentials(authorized_user_file,
     return credentials
 
 
-def get_value(group, key):
-    """Function that gets configuration from config file."""
+def get_config_path():
+    """Function that gets path of the config.ini file."""
+    return os.environ.get('CONFIG_FILE_PATH', default_config_filepath + "config.ini")
 
-    config_path = default_config_filepath + "config.ini"
-    if 'CONFIG_FILE_PATH' in os.environ:
-        config_path = os.environ['CONFIG_FILE_PATH']
 
-    config = configparser.ConfigParser()
+def get_config():
+    """Function that gets parsed configuration, reading config file only if it has changed."""
+
+    config_path = get_config_path()
+    file_stat = os.stat(config_path)
     readable_by_others = stat.S_IRGRP | stat.S_IROTH
-    is_protected = not bool(os.stat(config_path).st_mode & readable_by_others)
+    is_protected = not bool(file_stat.st_mode & readable_by_others)
     if not is_protected:
         raise Exception("Configuration file {config} is not protected, " +
                         "make sure you're the only one allowed to read " +
                         "it by executing `chmod 600 {config}`".format(config=config_path))
-    config.read(config_path)
-    return config.get(group, key)
+
+    cache_key = (config_path, file_stat.st_mtime_ns, file_stat.st_size)
+    with _config_lock:
+        if _config_cache['key'] == cache_key:
+            _config_stats['hits'] += 1
+            return _config_cache['parser']
+
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        _config_stats['reads'] += 1
+        _config_cache['key'] = cache_key
+        _config_cache['parser'] = config
+        return config
+
+
+def clear_config_cache():
+    """Function that forces config file to be read again on next access."""
+    with _config_lock:
+        _config_cache['key'] = None
+        _config_cache['parser'] = None
+
+
+def get_config_cache_stats():
+    """Function that returns number of config file reads and cache hits."""
+    with _config_lock:
+        return dict(_config_stats)
+
+
+def get_value(group, key):
+    """Function that gets configuration from config file."""
+    return get_config().get(group, key)
 
 
 def has_value(group, key):
-    try:
-        get_value(group, key)
-        return True
-    except (configparser.NoSectionError, configparser.NoOptionError):
-        return False
+    return get_config().has_option(group, key)
 
 
 def get_file_path(group):
     """Function that gets configuration files for APIs."""
-    if group == 'google_ad_manager':
-        return os.environ.get('CONFIG_AD_MANAGER', os.path.join(default_config_filepath, 'ad_manager.json'))
-    if group == 'google_analytics':
-        return os.environ.get('CONFIG_GOOGLE_ANALYTICS', os.path.join(default_config_filepath, 'client_secrets.json'))
-    if group == 'google_drive':
-        return os.environ.get('CONFIG_GOOGLE_DRIVE', os.path.join(default_config_filepath, 'credentials.json'))
-    if group == 'google_bigquery':
-        return os.environ.get('GOOGLE_APPLICATION_CREDENTIALS',
-                              os.path.join(default_config_filepath, 'bigquery_credentials.json'))
+    if group not in _file_path_settings:
+        return None
+    env_variable, filename = _file_path_settings[group]
+    return os.environ.get(env_variable, os.path.join(default_config_filepath, filename))
 
 
 def setup_env_variables(filepath=None):
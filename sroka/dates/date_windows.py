@@ -0,0 +1,27 @@
+import datetime
+
+SHARD_BY_VALUES = ('day', 'week', 'month')
+
+
+def split_into_windows(start, end, shard_by='month'):
+    """
+    Splits the range of dates from start to end (datetime.date, both inclusive) into day, week (Monday to Sunday)
+    or month windows.
+
+    :return: a list of (start date, end date) tuples of datetime.date objects, empty if start is after end
+    """
+    if shard_by not in SHARD_BY_VALUES:
+        raise ValueError('shard_by has three valid values: day, week, month')
+    windows = []
+    while start <= end:
+        if shard_by == 'day':
+            window_end = start
+        elif shard_by == 'week':
+            window_end = start + datetime.timedelta(days=6 - start.weekday())
+        else:
+            next_month = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+            window_end = next_month - datetime.timedelta(days=1)
+        window_end = min(window_end, end)
+        windows.append((start, window_end))
+        start = window_end + datetime.timedelta(days=1)
+    return windows